@@ -0,0 +1,155 @@
+import time
+import threading
+from functools import wraps
+from flask import current_app, jsonify
+
+class AdmissionPool:
+    """Bounded concurrency for one class of requests, with a short wait queue.
+
+    Slots stand for database connections: a request takes as many as it may
+    hold at once (one for most, more for requests that fan out). Up to
+    max_concurrent slots are in use at once and up to max_queue requests wait
+    at most queue_timeout seconds for theirs. When target_latency is set, an
+    exponentially weighted average of observed latency is kept and the limit
+    shrinks in proportion once it exceeds the target, down to a single request
+    so the pool can recover as latency improves. Limits apply per process.
+    """
+
+    def __init__(self, name, max_concurrent, max_queue=0, queue_timeout=0.0,
+                 target_latency=None, retry_after=1, latency_alpha=0.2):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.retry_after = retry_after
+        self.latency_alpha = latency_alpha
+        self.latency = None
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def limit(self):
+        """Current concurrency limit after any latency based reduction."""
+        if self.target_latency and self.latency and self.latency > self.target_latency:
+            return max(1, int(self.max_concurrent * self.target_latency / self.latency))
+        return self.max_concurrent
+
+    def _fits(self, slots):
+        # A request wider than the limit still runs, alone
+        return self.active == 0 or self.active + slots <= self.limit()
+
+    def acquire(self, slots=1):
+        """Take slots; returns None when admitted, else (status_code, message)."""
+        with self._condition:
+            if self._fits(slots):
+                self.active += slots
+                return None
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return 429, f'Too many concurrent {self.name} requests'
+            self.waiting += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while not self._fits(slots):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return 503, f'Timed out waiting for {self.name} capacity'
+                    self._condition.wait(remaining)
+                self.active += slots
+                return None
+            finally:
+                self.waiting -= 1
+
+    def release(self, slots=1):
+        with self._condition:
+            self.active -= slots
+            self._condition.notify_all()
+
+    def observe_latency(self, seconds):
+        """Fold one latency sample into the moving average."""
+        with self._condition:
+            previous_limit = self.limit()
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency += self.latency_alpha * (seconds - self.latency)
+            if self.limit() > previous_limit:
+                self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'active': self.active,
+                'waiting': self.waiting,
+                'limit': self.limit(),
+                'max_concurrent': self.max_concurrent,
+                'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+                'rejected': self.rejected
+            }
+
+_pools_lock = threading.Lock()
+
+def get_admission_pools(app):
+    """Return the app's admission pools, built from ADMISSION_POOLS on first use."""
+    if 'admission_pools' not in app.extensions:
+        with _pools_lock:
+            if 'admission_pools' not in app.extensions:
+                pools = {
+                    name: AdmissionPool(name, **settings)
+                    for name, settings in app.config['ADMISSION_POOLS'].items()
+                }
+                check_connection_budget(app.config, pools)
+                app.extensions['admission_pools'] = pools
+    return app.extensions['admission_pools']
+
+def check_connection_budget(config, pools):
+    """Warn when the pools together can hold more connections than the engine pool has."""
+    engine_options = config['SQLALCHEMY_ENGINE_OPTIONS']
+    if 'pool_size' not in engine_options:
+        return
+    connections = engine_options['pool_size'] + engine_options.get('max_overflow', 0)
+    slots = sum(pool.max_concurrent for pool in pools.values())
+    if slots > connections:
+        print(f"Admission pools allow {slots} concurrent connections but the engine pool has {connections}; "
+              f"ingest load can still starve stats reads of connections")
+
+def rejection_response(pool, rejection):
+    """Fast 429/503 response telling the client when to retry."""
+    status_code, message = rejection
+    response = jsonify({'error': message, 'retry_after': pool.retry_after})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(pool.retry_after)
+    return response
+
+def get_admission_pool(app, name):
+    """Return the named pool, or None when admission control is off or the pool is not configured."""
+    if not app.config['ADMISSION_CONTROL_ENABLED']:
+        return None
+    return get_admission_pools(app).get(name)
+
+def admission_control(pool_name, slots=1):
+    """Run the view inside slots of the named pool, or reject it with Retry-After.
+
+    slots may be a callable, evaluated per request.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            pool = get_admission_pool(current_app, pool_name)
+            if pool is None:
+                return view(*args, **kwargs)
+
+            needed = slots() if callable(slots) else slots
+            rejection = pool.acquire(needed)
+            if rejection:
+                return rejection_response(pool, rejection)
+
+            try:
+                return view(*args, **kwargs)
+            finally:
+                pool.release(needed)
+        return wrapper
+    return decorator
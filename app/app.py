@@ -1,4 +1,4 @@
-from flask import Flask
+from flask import Flask, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
@@ -13,9 +13,10 @@ celery = Celery('analytics_dashboard',
                 backend='redis://localhost:6379/0',
                 broker_connection_retry_on_startup=True)
 
-def create_app(config_name='default'):
+def create_app(config_name='default', **config_overrides):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
+    app.config.update(config_overrides)
 
     # Initialize extensions with app
     db.init_app(app)
@@ -25,6 +26,16 @@ def create_app(config_name='default'):
     # Initialize Celeryx
     celery.conf.update(app.config)
 
+    class ContextTask(celery.Task):
+        def __call__(self, *args, **kwargs):
+            # Tasks called inline from a request already have an app context
+            if has_app_context():
+                return super().__call__(*args, **kwargs)
+            with app.app_context():
+                return super().__call__(*args, **kwargs)
+
+    celery.Task = ContextTask
+
     # Register blueprints
     from app.routes import bp
     app.register_blueprint(bp)
@@ -0,0 +1,224 @@
+import time
+import threading
+from datetime import datetime, timedelta, UTC
+import numpy as np
+from sqlalchemy import func
+from app import db
+from app.models import EventAggregate, EventDefinition, AggregationRun
+from app.planner import PERIOD_TYPES, cover_range, finalized_periods
+from app.timeseries import to_naive_utc
+
+# Bytes per cached row across all column arrays
+ROW_BYTES = 8 + 8 + 1 + 4 + 2 + 8
+
+class AggregateColumnCache:
+    """Recent event_aggregates held as NumPy column arrays, sorted by period_start.
+
+    period_type and device_type are dictionary encoded into small integer
+    codes, and event names are resolved through the event_definitions ids.
+    Only rows with period_start at or after coverage_start are held; queries
+    reaching further back return None so the caller falls back to SQL. The
+    finalized periods in that window are loaded with the rows, so queries are
+    planned without a database round trip.
+    """
+
+    def __init__(self, days, max_bytes, refresh_seconds):
+        self.days = days
+        self.max_rows = max_bytes // ROW_BYTES
+        self.refresh_seconds = refresh_seconds
+        self.columns = None
+        self.coverage_start = None
+        self.definitions = {}
+        self.finalized = set()
+        self.hourly_days = set()
+        self.devices = []
+        self.watermark = None
+        self.last_run_finished_at = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def ensure_fresh(self):
+        """Load the cache, or apply changes from aggregation runs finished since the last check."""
+        if self.columns is not None and time.monotonic() - self.checked_at < self.refresh_seconds:
+            return
+        with self._lock:
+            if self.columns is not None and time.monotonic() - self.checked_at < self.refresh_seconds:
+                return
+            last_run = db.session.query(func.max(AggregationRun.finished_at)).filter(
+                AggregationRun.status == 'succeeded'
+            ).scalar()
+            if self.columns is None or (last_run and last_run != self.last_run_finished_at):
+                self.refresh()
+                self.last_run_finished_at = last_run
+            self.checked_at = time.monotonic()
+
+    def refresh(self):
+        """Load rows changed since the watermark (all rows in range on first load)."""
+        now = datetime.now(UTC).replace(tzinfo=None)
+        coverage_start = (now - timedelta(days=self.days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.columns is not None and self.coverage_start is not None:
+            # Periods dropped by the memory cap are not loaded back incrementally
+            coverage_start = max(coverage_start, self.coverage_start)
+
+        query = db.session.query(
+            EventAggregate.id,
+            EventAggregate.period_start,
+            EventAggregate.period_type,
+            EventAggregate.event_definition_id,
+            EventAggregate.device_type,
+            EventAggregate.count,
+            EventAggregate.updated_at
+        ).filter(EventAggregate.period_start >= coverage_start)
+        if self.columns is not None and self.watermark is not None:
+            query = query.filter(EventAggregate.updated_at >= self.watermark)
+        rows = query.all()
+
+        self.definitions = {
+            definition.id: (definition.event_type, definition.event_name)
+            for definition in EventDefinition.query.all()
+        }
+        devices = list(self.devices)
+        device_codes = {device: code for code, device in enumerate(devices)}
+        for row in rows:
+            if row.device_type not in device_codes:
+                device_codes[row.device_type] = len(devices)
+                devices.append(row.device_type)
+
+        new = {
+            'id': np.array([row.id for row in rows], dtype=np.int64),
+            'period_start': np.array([row.period_start for row in rows], dtype='datetime64[s]'),
+            'period_type': np.array([PERIOD_TYPES.index(row.period_type) for row in rows], dtype=np.int8),
+            'definition_id': np.array([row.event_definition_id for row in rows], dtype=np.int32),
+            'device': np.array([device_codes[row.device_type] for row in rows], dtype=np.int16),
+            'count': np.array([row.count or 0 for row in rows], dtype=np.int64),
+        }
+
+        columns = self.columns
+        if columns is not None:
+            # Replace updated rows and drop rows that aged out of the window
+            keep = ~np.isin(columns['id'], new['id']) & (columns['period_start'] >= np.datetime64(coverage_start, 's'))
+            new = {name: np.concatenate([columns[name][keep], new[name]]) for name in columns}
+
+        order = np.argsort(new['period_start'], kind='stable')
+        new = {name: values[order] for name, values in new.items()}
+
+        if len(new['id']) > self.max_rows:
+            # Over the memory cap: keep the most recent whole periods only
+            cutoff = new['period_start'][len(new['id']) - self.max_rows - 1]
+            keep = new['period_start'] > cutoff
+            new = {name: values[keep] for name, values in new.items()}
+            coverage_start = max(coverage_start, cutoff.item() + timedelta(seconds=1))
+
+        updated = [row.updated_at for row in rows if row.updated_at]
+        if updated:
+            self.watermark = max([self.watermark, *updated]) if self.watermark else max(updated)
+        hourly = new['period_start'][new['period_type'] == PERIOD_TYPES.index('hourly')]
+        self.hourly_days = set(np.unique(hourly.astype('datetime64[D]')).astype('datetime64[s]').tolist())
+        self.finalized = finalized_periods(coverage_start, now + timedelta(days=1))
+        self.devices = devices
+        self.coverage_start = coverage_start
+        self.columns = new
+
+    def covers(self, start_date):
+        return self.columns is not None and to_naive_utc(start_date) >= self.coverage_start
+
+    def _base_mask(self, columns, args, start_date, end_date):
+        start = np.datetime64(to_naive_utc(start_date), 's')
+        end = np.datetime64(to_naive_utc(end_date), 's')
+        mask = (columns['period_start'] >= start) & (columns['period_start'] <= end)
+        event_type = args.get('event_type')
+        if event_type:
+            mask &= np.isin(columns['definition_id'], self._definition_ids(event_type=event_type))
+        device_type = args.get('device_type')
+        if device_type:
+            code = self.devices.index(device_type) if device_type in self.devices else -1
+            mask &= columns['device'] == code
+        return mask
+
+    def _definition_ids(self, event_type=None, event_name=None):
+        return np.array([
+            definition_id for definition_id, (definition_type, definition_name) in self.definitions.items()
+            if (event_type is None or definition_type == event_type)
+            and (event_name is None or definition_name == event_name)
+        ], dtype=np.int32)
+
+    def _plan_mask(self, columns, start_date, end_date):
+        mask = np.zeros(len(columns['id']), dtype=bool)
+        starts_by_type = {}
+        for period_type, period_start in cover_range(start_date, end_date, self.finalized, self.hourly_days):
+            starts_by_type.setdefault(period_type, []).append(period_start)
+        for period_type, starts in starts_by_type.items():
+            mask |= (columns['period_type'] == PERIOD_TYPES.index(period_type)) & np.isin(
+                columns['period_start'], np.array(starts, dtype='datetime64[s]')
+            )
+        return mask
+
+    def page(self, columns, mask, args, page, per_page):
+        """Sort and slice the selected rows; None if the sort needs SQL."""
+        sort_by = args.get('sort_by', 'period_start')
+        if sort_by not in ('period_start', 'count'):
+            return None
+        selected = np.flatnonzero(mask)
+        order = np.argsort(columns[sort_by][selected], kind='stable')
+        if args.get('sort_order', 'desc') == 'desc':
+            order = order[::-1]
+        return selected[order][(page - 1) * per_page:page * per_page], len(selected)
+
+    def overview(self, args, start_date, end_date, page, per_page):
+        columns = self.columns
+        mask = self._base_mask(columns, args, start_date, end_date)
+        mask &= columns['period_type'] == PERIOD_TYPES.index('daily')
+        result = self.page(columns, mask, args, page, per_page)
+        if result is None:
+            return None
+        rows, total = result
+        return [{
+            'date': columns['period_start'][i].item().date().isoformat(),
+            'event_type': self.definitions[int(columns['definition_id'][i])][0],
+            'event_name': self.definitions[int(columns['definition_id'][i])][1],
+            'count': int(columns['count'][i]),
+            'device_type': self.devices[columns['device'][i]]
+        } for i in rows], total
+
+    def event_counts(self, args, start_date, end_date, period_type, page, per_page):
+        columns = self.columns
+        mask = self._base_mask(columns, args, start_date, end_date)
+        mask &= np.isin(columns['definition_id'], self._definition_ids(event_name=args.get('event_name')))
+        total_count = int(columns['count'][mask & self._plan_mask(columns, start_date, end_date)].sum())
+        mask &= columns['period_type'] == PERIOD_TYPES.index(period_type)
+        result = self.page(columns, mask, args, page, per_page)
+        if result is None:
+            return None
+        rows, total = result
+        return [{
+            'period_start': columns['period_start'][i].item().isoformat(),
+            'period_type': period_type,
+            'count': int(columns['count'][i]),
+            'device_type': self.devices[columns['device'][i]]
+        } for i in rows], total, total_count
+
+    def top_events(self, start_date, end_date, limit):
+        columns = self.columns
+        mask = self._plan_mask(columns, start_date, end_date)
+        definition_ids, inverse = np.unique(columns['definition_id'][mask], return_inverse=True)
+        totals = np.bincount(inverse, weights=columns['count'][mask], minlength=len(definition_ids))
+        order = np.argsort(-totals, kind='stable')[:limit]
+        return [{
+            'event_type': self.definitions[int(definition_ids[i])][0],
+            'event_name': self.definitions[int(definition_ids[i])][1],
+            'total_count': int(totals[i])
+        } for i in order]
+
+def get_aggregate_cache(app):
+    """Return the app's aggregate cache, or None when AGGREGATE_CACHE_ENABLED is off."""
+    if not app.config['AGGREGATE_CACHE_ENABLED']:
+        return None
+    if 'aggregate_cache' not in app.extensions:
+        app.extensions['aggregate_cache'] = AggregateColumnCache(
+            app.config['AGGREGATE_CACHE_DAYS'],
+            app.config['AGGREGATE_CACHE_MAX_BYTES'],
+            app.config['AGGREGATE_CACHE_REFRESH_SECONDS']
+        )
+    cache = app.extensions['aggregate_cache']
+    cache.ensure_fresh()
+    return cache
@@ -0,0 +1,131 @@
+import math
+import time
+import hashlib
+import threading
+from app.locks import get_redis_client
+
+def bloom_parameters(capacity, error_rate):
+    """Return (num_bits, num_hashes) for capacity items at the given false positive rate."""
+    num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+    return num_bits, num_hashes
+
+def bloom_positions(key, num_bits, num_hashes):
+    """Bit positions for key, using double hashing over one blake2b digest."""
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+class BloomFilter:
+    """A fixed size Bloom filter held in a bytearray."""
+
+    def __init__(self, capacity, error_rate):
+        self.num_bits, self.num_hashes = bloom_parameters(capacity, error_rate)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def add(self, key):
+        for position in bloom_positions(key, self.num_bits, self.num_hashes):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def might_contain(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in bloom_positions(key, self.num_bits, self.num_hashes)
+        )
+
+class RotatingBloomFilter:
+    """In-process Bloom filter that only remembers recent keys.
+
+    Keys go into the current generation, and lookups check both the current
+    and the previous generation. The current one is retired once it is full or
+    older than rotation_seconds, which bounds memory and the false positive
+    rate. A key can be forgotten after two rotations.
+    """
+
+    def __init__(self, capacity, error_rate, rotation_seconds):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rotation_seconds = rotation_seconds
+        self.previous = None
+        self.current = BloomFilter(capacity, error_rate)
+        self.rotated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _rotate_if_needed(self):
+        if self.current.count >= self.capacity or time.monotonic() - self.rotated_at >= self.rotation_seconds:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.rotated_at = time.monotonic()
+
+    def add(self, key):
+        with self._lock:
+            self._rotate_if_needed()
+            self.current.add(key)
+
+    def might_contain(self, key):
+        with self._lock:
+            self._rotate_if_needed()
+            return self.current.might_contain(key) or (
+                self.previous is not None and self.previous.might_contain(key)
+            )
+
+class RedisBloomFilter:
+    """Rotating Bloom filter in Redis bitmaps, shared by every ingest process.
+
+    Each generation is a bitmap keyed by its rotation window and expires after
+    two windows. Lookups check the current and previous generation in one
+    pipelined round trip.
+    """
+
+    def __init__(self, url, capacity, error_rate, rotation_seconds, prefix='bloom:event_ids'):
+        self.client = get_redis_client(url)
+        self.num_bits, self.num_hashes = bloom_parameters(capacity, error_rate)
+        self.rotation_seconds = rotation_seconds
+        self.prefix = prefix
+
+    def _key(self, generation):
+        return f'{self.prefix}:{generation}'
+
+    def add(self, key):
+        generation = int(time.time() // self.rotation_seconds)
+        pipe = self.client.pipeline(transaction=False)
+        for position in bloom_positions(key, self.num_bits, self.num_hashes):
+            pipe.setbit(self._key(generation), position, 1)
+        pipe.expire(self._key(generation), self.rotation_seconds * 2)
+        pipe.execute()
+
+    def might_contain(self, key):
+        generation = int(time.time() // self.rotation_seconds)
+        positions = bloom_positions(key, self.num_bits, self.num_hashes)
+        pipe = self.client.pipeline(transaction=False)
+        for key_generation in (generation, generation - 1):
+            for position in positions:
+                pipe.getbit(self._key(key_generation), position)
+        bits = pipe.execute()
+        return all(bits[:len(positions)]) or all(bits[len(positions):])
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+def get_event_id_filter(config):
+    """Return the process-wide Bloom filter of recently seen client event ids."""
+    backend = config['EVENT_DEDUPE_BACKEND']
+    with _filters_lock:
+        if backend not in _filters:
+            if backend == 'redis':
+                _filters[backend] = RedisBloomFilter(
+                    config['EVENT_DEDUPE_REDIS_URL'],
+                    config['EVENT_DEDUPE_CAPACITY'],
+                    config['EVENT_DEDUPE_ERROR_RATE'],
+                    config['EVENT_DEDUPE_ROTATION_SECONDS']
+                )
+            else:
+                _filters[backend] = RotatingBloomFilter(
+                    config['EVENT_DEDUPE_CAPACITY'],
+                    config['EVENT_DEDUPE_ERROR_RATE'],
+                    config['EVENT_DEDUPE_ROTATION_SECONDS']
+                )
+        return _filters[backend]
@@ -0,0 +1,98 @@
+from datetime import timedelta
+from itertools import groupby
+from sqlalchemy import select, func, and_
+from app import db
+from app.models import UserEvent, EventDefinition
+from app.timeseries import to_naive_utc
+
+def compute_funnel(steps, window, start_date, end_date, anchor_end=None):
+    """Count sessions reaching each step of an ordered funnel.
+
+    A session enters the funnel at its first occurrence of steps[0] and reaches
+    step k at the earliest steps[k] event at or after step k-1, as long as it is
+    within window seconds of entering. Only sessions entering before anchor_end
+    (defaults to end_date) are counted.
+    """
+    anchor_end = anchor_end or end_date
+    if db.engine.dialect.name == 'postgresql':
+        return _compute_funnel_sql(steps, window, start_date, end_date, anchor_end)
+    return _compute_funnel_python(steps, window, start_date, end_date, anchor_end)
+
+def _funnel_events(steps, start_date, end_date):
+    return select(
+        UserEvent.session_id,
+        EventDefinition.event_name,
+        UserEvent.timestamp,
+        UserEvent.id
+    ).join(
+        EventDefinition, EventDefinition.id == UserEvent.event_definition_id
+    ).where(
+        EventDefinition.event_name.in_(set(steps)),
+        UserEvent.timestamp >= start_date,
+        UserEvent.timestamp < end_date
+    )
+
+def _compute_funnel_sql(steps, window, start_date, end_date, anchor_end):
+    """Evaluate the funnel with one window function per step.
+
+    Every level partitions by session_id, so Postgres sorts the events once and
+    stacks the WindowAgg nodes on top of a single scan.
+    """
+    events = _funnel_events(steps, start_date, end_date).subquery()
+    level = select(
+        events,
+        func.min(events.c.timestamp).filter(
+            events.c.event_name == steps[0]
+        ).over(partition_by=events.c.session_id).label('t0')
+    ).subquery()
+
+    for k in range(1, len(steps)):
+        level = select(
+            level,
+            func.min(level.c.timestamp).filter(and_(
+                level.c.event_name == steps[k],
+                level.c.timestamp >= level.c[f't{k - 1}'],
+                level.c.timestamp <= level.c.t0 + timedelta(seconds=window)
+            )).over(partition_by=level.c.session_id).label(f't{k}')
+        ).subquery()
+
+    row = db.session.execute(select(*[
+        func.count(func.distinct(level.c.session_id)).filter(level.c[f't{k}'].isnot(None))
+        for k in range(len(steps))
+    ]).where(level.c.t0 < anchor_end)).one()
+    return list(row)
+
+def _compute_funnel_python(steps, window, start_date, end_date, anchor_end):
+    """Stream events sorted by (session_id, timestamp) through evaluate_funnel."""
+    query = _funnel_events(steps, start_date, end_date).order_by(
+        UserEvent.session_id,
+        UserEvent.timestamp,
+        UserEvent.id
+    ).execution_options(yield_per=1000)
+    rows = ((row.session_id, row.event_name, row.timestamp) for row in db.session.execute(query))
+    return evaluate_funnel(rows, steps, window, to_naive_utc(anchor_end))
+
+def evaluate_funnel(rows, steps, window, anchor_end=None):
+    """Single pass funnel evaluation over (session_id, event_name, timestamp)
+    rows sorted by session_id and timestamp."""
+    window = timedelta(seconds=window)
+    counts = [0] * len(steps)
+    for _, events in groupby(rows, key=lambda row: row[0]):
+        reached = 0
+        entered_at = None
+        for _, event_name, timestamp in events:
+            if reached == 0:
+                if event_name == steps[0]:
+                    if anchor_end is not None and timestamp >= anchor_end:
+                        break
+                    entered_at = timestamp
+                    reached = 1
+            elif timestamp > entered_at + window:
+                break
+            elif event_name == steps[reached]:
+                reached += 1
+            if reached == len(steps):
+                break
+        for k in range(reached):
+            counts[k] += 1
+    return counts
@@ -0,0 +1,130 @@
+import time
+import uuid
+import threading
+import redis
+
+# Only touch the key if it still holds our token
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_clients = {}
+_local_leases = {}
+_local_leases_lock = threading.Lock()
+
+class LeaseLostError(Exception):
+    """The lease expired or was taken over while work was being done under it."""
+
+def get_redis_client(url):
+    """Return a shared Redis client for url."""
+    if url not in _clients:
+        _clients[url] = redis.Redis.from_url(url)
+    return _clients[url]
+
+class LeaseLock:
+    """A lock that expires after ttl seconds unless its holder renews it.
+
+    While held with heartbeat enabled, a background thread renews the lease
+    every ttl / 3 seconds, so a crashed holder only blocks others for one ttl.
+    Passing the token of an existing lease lets another process renew or
+    release it. Without a Redis url the lease is only held in this process.
+    """
+
+    def __init__(self, name, url=None, ttl=60, token=None):
+        self.name = f'lock:{name}'
+        self.client = get_redis_client(url) if url else None
+        self.ttl = ttl
+        self.token = token or uuid.uuid4().hex
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self, heartbeat=True):
+        """Try to take the lease without waiting. Returns True on success."""
+        if self.client is not None:
+            acquired = bool(self.client.set(self.name, self.token, nx=True, px=int(self.ttl * 1000)))
+        else:
+            with _local_leases_lock:
+                holder = _local_leases.get(self.name)
+                acquired = holder is None or holder[1] <= time.monotonic()
+                if acquired:
+                    _local_leases[self.name] = (self.token, time.monotonic() + self.ttl)
+
+        if acquired and heartbeat:
+            self._start_heartbeat()
+        return acquired
+
+    def hold(self):
+        """Keep an existing lease (taken by token) alive until release or stop_heartbeat.
+
+        Returns False if the lease is no longer ours.
+        """
+        if not self.renew():
+            self.lost = True
+            return False
+        self._start_heartbeat()
+        return True
+
+    def check(self):
+        """Raise LeaseLostError if the heartbeat failed to renew the lease."""
+        if self.lost:
+            raise LeaseLostError(f'Lease {self.name} was lost')
+
+    def renew(self):
+        """Extend the lease by another ttl. Returns False if it is no longer ours."""
+        if self.client is not None:
+            return bool(self.client.eval(_RENEW_SCRIPT, 1, self.name, self.token, int(self.ttl * 1000)))
+        with _local_leases_lock:
+            holder = _local_leases.get(self.name)
+            if holder is None or holder[0] != self.token or holder[1] <= time.monotonic():
+                return False
+            _local_leases[self.name] = (self.token, time.monotonic() + self.ttl)
+            return True
+
+    def stop_heartbeat(self):
+        """Stop renewing the lease without dropping it."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def release(self):
+        """Stop the heartbeat and drop the lease if we still hold it."""
+        self.stop_heartbeat()
+        if self.client is not None:
+            self.client.eval(_RELEASE_SCRIPT, 1, self.name, self.token)
+            return
+        with _local_leases_lock:
+            holder = _local_leases.get(self.name)
+            if holder is not None and holder[0] == self.token:
+                del _local_leases[self.name]
+
+    def _start_heartbeat(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew_until_stopped, daemon=True)
+        self._heartbeat.start()
+
+    def _renew_until_stopped(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    self.lost = True
+                    return
+            except redis.RedisError as e:
+                # Keep trying until the lease runs out
+                print(f"Error renewing lock {self.name}: {str(e)}")
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -1,6 +1,105 @@
 from datetime import datetime
+from threading import Lock
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, declared_attr
 from app import db
 
+# In-process interning cache of (event_type, event_name) -> event_definitions.id.
+# Only ids that are known to be committed are cached; definitions created inside a
+# transaction stay in session.info until that transaction commits.
+_definition_cache = {}
+_definition_cache_lock = Lock()
+_PENDING_DEFINITIONS_KEY = 'pending_event_definitions'
+
+class EventDefinition(db.Model):
+    __tablename__ = 'event_definitions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    event_name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('event_type', 'event_name', name='unique_event_definition'),
+    )
+
+    @classmethod
+    def get_id(cls, event_type, event_name):
+        """Resolve (event_type, event_name) to its integer id, creating it if needed."""
+        key = (event_type, event_name)
+        definition_id = _definition_cache.get(key)
+        if definition_id is not None:
+            return definition_id
+
+        pending = db.session.info.setdefault(_PENDING_DEFINITIONS_KEY, {})
+        if key in pending:
+            return pending[key]
+
+        with db.session.no_autoflush:
+            definition = cls.query.filter_by(event_type=event_type, event_name=event_name).first()
+        if definition is None:
+            definition = cls(event_type=event_type, event_name=event_name)
+            try:
+                with db.session.begin_nested():
+                    db.session.add(definition)
+            except IntegrityError:
+                # Another worker created it concurrently
+                with db.session.no_autoflush:
+                    definition = cls.query.filter_by(event_type=event_type, event_name=event_name).one()
+            else:
+                pending[key] = definition.id
+                return definition.id
+
+        with _definition_cache_lock:
+            _definition_cache[key] = definition.id
+        return definition.id
+
+    def __repr__(self):
+        return f'<EventDefinition {self.event_type}:{self.event_name}>'
+
+@event.listens_for(Session, 'after_commit')
+def _promote_pending_definitions(session):
+    pending = session.info.pop(_PENDING_DEFINITIONS_KEY, None)
+    if pending:
+        with _definition_cache_lock:
+            _definition_cache.update(pending)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending_definitions(session):
+    session.info.pop(_PENDING_DEFINITIONS_KEY, None)
+
+@event.listens_for(EventDefinition.__table__, 'after_create')
+@event.listens_for(EventDefinition.__table__, 'after_drop')
+def _clear_definition_cache(*args, **kwargs):
+    with _definition_cache_lock:
+        _definition_cache.clear()
+
+class EventDefinitionMixin:
+    """Stores event_type/event_name as an event_definitions id while keeping
+    string attributes on the model."""
+
+    @declared_attr
+    def event_definition_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('event_definitions.id'), nullable=False, index=True)
+
+    @declared_attr
+    def definition(cls):
+        return db.relationship('EventDefinition', lazy='joined')
+
+    def __init__(self, event_type=None, event_name=None, **kwargs):
+        if event_type is not None and event_name is not None:
+            kwargs.setdefault('event_definition_id', EventDefinition.get_id(event_type, event_name))
+        super().__init__(**kwargs)
+
+    @property
+    def event_type(self):
+        return self.definition.event_type if self.definition else None
+
+    @property
+    def event_name(self):
+        return self.definition.event_name if self.definition else None
+
 class UserSession(db.Model):
     __tablename__ = 'user_sessions'
 
@@ -18,28 +117,26 @@ class UserSession(db.Model):
     def __repr__(self):
         return f'<UserSession {self.session_id}>'
 
-class UserEvent(db.Model):
+class UserEvent(EventDefinitionMixin, db.Model):
     __tablename__ = 'user_events'
 
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(50), db.ForeignKey('user_sessions.session_id'), nullable=False)
-    event_type = db.Column(db.String(50), nullable=False)
-    event_name = db.Column(db.String(100), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     event_data = db.Column(db.JSON, nullable=True)
+    client_event_id = db.Column(db.String(64), unique=True, nullable=True)  # supplied by SDKs for retries
+    sample_weight = db.Column(db.Float, default=1.0, nullable=False)  # 1 / sampling rate at ingest
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f'<UserEvent {self.event_type}:{self.event_name}>'
 
-class EventAggregate(db.Model):
+class EventAggregate(EventDefinitionMixin, db.Model):
     __tablename__ = 'event_aggregates'
 
     id = db.Column(db.Integer, primary_key=True)
-    event_type = db.Column(db.String(50), nullable=False)
-    event_name = db.Column(db.String(100), nullable=False)
-    period_type = db.Column(db.String(20), nullable=False)  # daily, weekly, monthly
+    period_type = db.Column(db.String(20), nullable=False)  # hourly, daily, weekly, monthly
     period_start = db.Column(db.DateTime, nullable=False)
     count = db.Column(db.Integer, default=0)
     device_type = db.Column(db.String(50), nullable=True)  # mobile, desktop, etc.
@@ -47,9 +144,99 @@ class EventAggregate(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     __table_args__ = (
-        db.UniqueConstraint('event_type', 'event_name', 'period_type', 'period_start', 'device_type', 
+        db.UniqueConstraint('event_definition_id', 'period_type', 'period_start', 'device_type',
                           name='unique_event_aggregate'),
     )
 
     def __repr__(self):
         return f'<EventAggregate {self.event_type}:{self.event_name} {self.period_type}>'
+
+class AggregationPeriod(db.Model):
+    __tablename__ = 'aggregation_periods'
+
+    id = db.Column(db.Integer, primary_key=True)
+    period_type = db.Column(db.String(20), nullable=False)  # hourly, daily, weekly, monthly
+    period_start = db.Column(db.DateTime, nullable=False)
+    finalized_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('period_type', 'period_start', name='unique_aggregation_period'),
+    )
+
+    def __repr__(self):
+        return f'<AggregationPeriod {self.period_type} {self.period_start}>'
+
+class FunnelResult(db.Model):
+    __tablename__ = 'funnel_results'
+
+    id = db.Column(db.Integer, primary_key=True)
+    funnel_name = db.Column(db.String(100), nullable=False)
+    period_start = db.Column(db.DateTime, nullable=False)  # day the sessions entered the funnel
+    step_counts = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('funnel_name', 'period_start', name='unique_funnel_result'),
+    )
+
+    def __repr__(self):
+        return f'<FunnelResult {self.funnel_name} {self.period_start}>'
+
+class RetentionCohort(db.Model):
+    __tablename__ = 'retention_cohorts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    cohort_date = db.Column(db.DateTime, nullable=False)  # day the sessions first appeared
+    day_offset = db.Column(db.Integer, nullable=False)  # 0 is the cohort size
+    sessions = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('cohort_date', 'day_offset', name='unique_retention_cohort'),
+    )
+
+    def __repr__(self):
+        return f'<RetentionCohort {self.cohort_date} +{self.day_offset}>'
+
+class AggregationRun(db.Model):
+    __tablename__ = 'aggregation_runs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    period_type = db.Column(db.String(20), nullable=False)
+    period_start = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(20), default='queued', nullable=False)  # queued, running, succeeded, failed, skipped
+    shards = db.Column(db.Integer, default=1, nullable=False)
+    rows_scanned = db.Column(db.Integer, nullable=True)
+    groups_written = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_aggregation_runs_period', 'period_type', 'period_start'),
+    )
+
+    def to_dict(self):
+        return {
+            'run_id': self.id,
+            'period_type': self.period_type,
+            'period_start': self.period_start.isoformat(),
+            'status': self.status,
+            'shards': self.shards,
+            'rows_scanned': self.rows_scanned,
+            'groups_written': self.groups_written,
+            'error': self.error,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_seconds': (self.finished_at - self.started_at).total_seconds()
+                                if self.started_at and self.finished_at else None
+        }
+
+    def __repr__(self):
+        return f'<AggregationRun {self.id} {self.period_type} {self.status}>'
@@ -0,0 +1,92 @@
+from datetime import timedelta
+from sqlalchemy import and_, or_, false
+from app import db
+from app.models import EventAggregate, AggregationPeriod
+from app.services import get_period_bounds
+from app.timeseries import to_naive_utc
+
+# Coarsest first; hours are the finest rollup and fill in the edges
+PERIOD_TYPES = ['monthly', 'weekly', 'daily', 'hourly']
+
+def plan_rollups(start_date, end_date):
+    """Cover [start_date, end_date) with the coarsest complete rollups.
+
+    Returns (period_type, period_start) pieces that do not overlap. A month,
+    week or day is used when it lies inside the range and has been finalized.
+    What is left, including the day in progress, is covered by the next finer
+    period type, down to hours, so the answer is exact to the hour. A whole day
+    with no hourly rows, such as one aggregated before hourly rollups existed,
+    falls back to its daily row even when it was never finalized.
+    """
+    start = to_naive_utc(start_date).replace(minute=0, second=0, microsecond=0)
+    end = to_naive_utc(end_date)
+    return cover_range(start, end, finalized_periods(start, end), hourly_days(start, end))
+
+def finalized_periods(start_date, end_date):
+    """(period_type, period_start) of the finalized periods starting in the range."""
+    return {(period_type, period_start) for period_type, period_start in db.session.query(
+        AggregationPeriod.period_type,
+        AggregationPeriod.period_start
+    ).filter(
+        AggregationPeriod.period_start >= start_date,
+        AggregationPeriod.period_start < end_date,
+        AggregationPeriod.finalized_at.isnot(None)
+    )}
+
+def hourly_days(start_date, end_date):
+    """Start of each day in the range that has hourly rows."""
+    return {period_start.replace(hour=0) for (period_start,) in db.session.query(
+        EventAggregate.period_start
+    ).filter(
+        EventAggregate.period_type == 'hourly',
+        EventAggregate.period_start >= start_date,
+        EventAggregate.period_start < end_date
+    ).distinct()}
+
+def cover_range(start_date, end_date, finalized, days_with_hours):
+    """The planning step of plan_rollups, for callers that already hold the
+    finalized periods and the days with hourly rows."""
+    start = to_naive_utc(start_date).replace(minute=0, second=0, microsecond=0)
+    end = to_naive_utc(end_date)
+
+    def usable(period_type, period_start):
+        if (period_type, period_start) in finalized:
+            return True
+        return period_type == 'daily' and period_start not in days_with_hours
+
+    def cover(gap_start, gap_end, level):
+        if gap_start >= gap_end:
+            return []
+        period_type = PERIOD_TYPES[level]
+        if period_type == 'hourly':
+            pieces = []
+            while gap_start < gap_end:
+                pieces.append(('hourly', gap_start))
+                gap_start += timedelta(hours=1)
+            return pieces
+
+        pieces = []
+        period_start, period_end = get_period_bounds(period_type, gap_start)
+        if period_start < gap_start:
+            period_start, period_end = period_end, get_period_bounds(period_type, period_end)[1]
+        while period_start < gap_end:
+            if period_end <= gap_end and usable(period_type, period_start):
+                pieces += cover(gap_start, period_start, level + 1)
+                pieces.append((period_type, period_start))
+                gap_start = period_end
+            period_start, period_end = period_end, get_period_bounds(period_type, period_end)[1]
+        return pieces + cover(gap_start, gap_end, level + 1)
+
+    return cover(start, end, 0)
+
+def rollup_filter(pieces):
+    """SQL filter selecting the event_aggregates rows of a plan."""
+    starts_by_type = {}
+    for period_type, period_start in pieces:
+        starts_by_type.setdefault(period_type, []).append(period_start)
+    if not starts_by_type:
+        return false()
+    return or_(*[
+        and_(EventAggregate.period_type == period_type, EventAggregate.period_start.in_(starts))
+        for period_type, starts in starts_by_type.items()
+    ])
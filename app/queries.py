@@ -0,0 +1,461 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, UTC
+from flask import current_app
+from sqlalchemy import func, desc, and_, or_
+from sqlalchemy.orm import contains_eager
+import numpy as np
+from app import db, timeseries
+from app.timeseries import to_naive_utc
+from app.models import EventAggregate, EventDefinition, FunnelResult, RetentionCohort, AggregationPeriod
+from app.funnels import compute_funnel
+from app.planner import PERIOD_TYPES, plan_rollups, rollup_filter
+from app.column_cache import get_aggregate_cache
+
+class QueryError(Exception):
+    """A stats query that cannot be answered, reported to the client as-is."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def parse_date_range(args, default='7d'):
+    """Resolve the range, start_date and end_date arguments into datetimes."""
+    range_type = args.get('range', default)
+    end_date = datetime.now(UTC)
+    if range_type == '7d':
+        start_date = end_date - timedelta(days=7)
+    elif range_type == '30d':
+        start_date = end_date - timedelta(days=30)
+    else:
+        # Custom range
+        start_date = args.get('start_date')
+        end_date = args.get('end_date')
+        if not start_date or not end_date:
+            raise QueryError('start_date and end_date required for custom range')
+        try:
+            start_date = datetime.fromisoformat(start_date)
+            end_date = datetime.fromisoformat(end_date)
+        except ValueError:
+            raise QueryError('start_date and end_date must be ISO 8601 dates')
+    return start_date, end_date
+
+def parse_int(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except (TypeError, ValueError):
+        raise QueryError(f'{name} must be an integer')
+
+def parse_page(args):
+    page = parse_int(args, 'page', 1)
+    per_page = parse_int(args, 'per_page', 10)
+    if page < 1 or per_page < 1:
+        raise QueryError('Page not found', 404)
+    return page, per_page
+
+def pagination_block(page, per_page, total, has_items):
+    if not has_items and page != 1:
+        raise QueryError('Page not found', 404)
+    return {
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': math.ceil(total / per_page)
+    }
+
+def paginate(query, args):
+    """Return one page of query results along with the pagination block.
+
+    The total is computed with a window function in the page query itself, so
+    only an out of range page needs a separate COUNT.
+    """
+    page, per_page = parse_page(args)
+
+    # Apply sorting
+    sort_by = args.get('sort_by', 'period_start')
+    sort_order = args.get('sort_order', 'desc')
+    if sort_order == 'desc':
+        query = query.order_by(desc(sort_by))
+    else:
+        query = query.order_by(sort_by)
+
+    rows = query.add_columns(func.count().over().label('total')).limit(per_page).offset((page - 1) * per_page).all()
+    total = rows[0].total if rows else query.order_by(None).count()
+    return [row[0] for row in rows], pagination_block(page, per_page, total, bool(rows))
+
+def _cache_for(start_date):
+    """The aggregate cache if it is enabled and holds the whole range."""
+    cache = get_aggregate_cache(current_app)
+    return cache if cache and cache.covers(start_date) else None
+
+def _aggregate_query():
+    return EventAggregate.query.join(EventAggregate.definition).options(
+        contains_eager(EventAggregate.definition)
+    )
+
+def _apply_filters(query, args):
+    event_type = args.get('event_type')
+    device_type = args.get('device_type')
+    if event_type:
+        query = query.filter(EventDefinition.event_type == event_type)
+    if device_type:
+        query = query.filter(EventAggregate.device_type == device_type)
+    return query
+
+def query_overview(args):
+    """Get daily stats for a given period."""
+    start_date, end_date = parse_date_range(args)
+
+    cache = _cache_for(start_date)
+    cached = cache.overview(args, start_date, end_date, *parse_page(args)) if cache else None
+    if cached is not None:
+        data, total = cached
+        return {
+            'status': 'success',
+            'data': data,
+            'pagination': pagination_block(*parse_page(args), total, bool(data))
+        }
+
+    # Query daily aggregates
+    query = _aggregate_query().filter(
+        EventAggregate.period_type == 'daily',
+        EventAggregate.period_start >= start_date,
+        EventAggregate.period_start <= end_date
+    )
+    items, pagination = paginate(_apply_filters(query, args), args)
+
+    return {
+        'status': 'success',
+        'data': [{
+            'date': agg.period_start.date().isoformat(),
+            'event_type': agg.event_type,
+            'event_name': agg.event_name,
+            'count': agg.count,
+            'device_type': agg.device_type
+        } for agg in items],
+        'pagination': pagination
+    }
+
+def query_event_counts(args):
+    """Get aggregated counts for specific events.
+
+    Rows are listed for a single period_type (daily by default), and
+    total_count sums the event over the whole range using the query planner.
+    """
+    event_name = args.get('event_name')
+    if not event_name:
+        raise QueryError('event_name is required')
+
+    period_type = args.get('period_type', 'daily')
+    if period_type not in PERIOD_TYPES:
+        raise QueryError(f"Invalid period type. Must be one of: {', '.join(PERIOD_TYPES)}")
+
+    start_date, end_date = parse_date_range(args)
+
+    cache = _cache_for(start_date)
+    cached = cache.event_counts(args, start_date, end_date, period_type, *parse_page(args)) if cache else None
+    if cached is not None:
+        data, total, total_count = cached
+        return {
+            'status': 'success',
+            'data': data,
+            'total_count': total_count,
+            'pagination': pagination_block(*parse_page(args), total, bool(data))
+        }
+
+    # Query aggregates
+    query = _aggregate_query().filter(
+        EventDefinition.event_name == event_name,
+        EventAggregate.period_type == period_type,
+        EventAggregate.period_start >= start_date,
+        EventAggregate.period_start <= end_date
+    )
+    items, pagination = paginate(_apply_filters(query, args), args)
+
+    total_query = db.session.query(
+        func.coalesce(func.sum(EventAggregate.count), 0)
+    ).join(
+        EventDefinition, EventDefinition.id == EventAggregate.event_definition_id
+    ).filter(
+        EventDefinition.event_name == event_name,
+        rollup_filter(plan_rollups(start_date, end_date))
+    )
+
+    return {
+        'status': 'success',
+        'data': [{
+            'period_start': agg.period_start.isoformat(),
+            'period_type': agg.period_type,
+            'count': agg.count,
+            'device_type': agg.device_type
+        } for agg in items],
+        'total_count': _apply_filters(total_query, args).scalar(),
+        'pagination': pagination
+    }
+
+def query_top_events(args):
+    """Get top N most triggered events."""
+    limit = parse_int(args, 'limit', 10)
+    start_date, end_date = parse_date_range(args)
+
+    cache = _cache_for(start_date)
+    if cache:
+        return {
+            'status': 'success',
+            'data': cache.top_events(start_date, end_date, limit)
+        }
+
+    # Query top events over the coarsest rollups covering the range,
+    # grouping on the integer definition id
+    totals = db.session.query(
+        EventAggregate.event_definition_id,
+        func.sum(EventAggregate.count).label('total_count')
+    ).filter(
+        rollup_filter(plan_rollups(start_date, end_date))
+    ).group_by(
+        EventAggregate.event_definition_id
+    ).subquery()
+
+    top_events = db.session.query(
+        EventDefinition.event_type,
+        EventDefinition.event_name,
+        totals.c.total_count
+    ).join(
+        totals, totals.c.event_definition_id == EventDefinition.id
+    ).order_by(
+        desc(totals.c.total_count)
+    ).limit(limit).all()
+
+    return {
+        'status': 'success',
+        'data': [{
+            'event_type': event.event_type,
+            'event_name': event.event_name,
+            'total_count': event.total_count
+        } for event in top_events]
+    }
+
+def query_timeseries(args):
+    """Get a dense, gap-filled series of counts for an event.
+
+    The payload is columnar: timestamps holds the bucket starts in epoch
+    seconds and values (or series, when grouped) holds one count per bucket.
+    """
+    event_name = args.get('event_name')
+    if not event_name:
+        raise QueryError('event_name is required')
+
+    bucket = args.get('bucket', 'day')
+    if bucket not in timeseries.BUCKETS:
+        raise QueryError(f"Invalid bucket. Must be one of: {', '.join(timeseries.BUCKETS)}")
+
+    group_by = args.get('group_by')
+    if group_by not in (None, 'device_type'):
+        raise QueryError('group_by must be device_type')
+
+    start_date, end_date = parse_date_range(args, default='30d')
+
+    edges = timeseries.bucket_edges(start_date, end_date, bucket)
+    range_start = edges[0].item()
+    range_end = edges[-1].item()
+    now = datetime.now(UTC).replace(tzinfo=None)
+    elapsed_buckets = int((edges[1:] <= np.datetime64(now)).sum())
+
+    # Read the coarsest period type with finalized rollups for every elapsed
+    # bucket. Rows for the bucket still in progress are only written at the
+    # period boundary, so that bucket is read through the query planner, which
+    # covers the current day with hourly rollups like /stats/top-events
+    in_progress_start = edges[elapsed_buckets].item() if elapsed_buckets < len(edges) - 1 else range_end
+    source = 'daily'
+    for period_type in timeseries.BUCKET_SOURCES[bucket][:-1]:
+        finalized = AggregationPeriod.query.filter(
+            AggregationPeriod.period_type == period_type,
+            AggregationPeriod.period_start >= range_start,
+            AggregationPeriod.period_start < range_end,
+            AggregationPeriod.finalized_at.isnot(None)
+        ).count()
+        if finalized >= elapsed_buckets:
+            source = period_type
+            break
+
+    query = db.session.query(
+        EventAggregate.period_start,
+        EventAggregate.device_type,
+        EventAggregate.count
+    ).join(
+        EventDefinition, EventDefinition.id == EventAggregate.event_definition_id
+    ).filter(
+        EventDefinition.event_name == event_name,
+        EventAggregate.period_start >= range_start,
+        EventAggregate.period_start < range_end,
+        or_(
+            and_(EventAggregate.period_type == source, EventAggregate.period_start < in_progress_start),
+            rollup_filter(plan_rollups(in_progress_start, now) if in_progress_start < now else [])
+        )
+    )
+
+    rows = _apply_filters(query, args).all()
+    period_starts = timeseries.to_datetime64([row.period_start for row in rows])
+    counts = np.array([row.count or 0 for row in rows], dtype=np.int64)
+
+    result = {
+        'status': 'success',
+        'bucket': bucket,
+        'source_period_type': source,
+        'timestamps': timeseries.to_epoch_seconds(edges),
+        'values': timeseries.resample(period_starts, counts, edges).tolist()
+    }
+    if group_by == 'device_type':
+        devices = np.array([row.device_type or 'unknown' for row in rows], dtype=object)
+        result['series'] = {
+            device: timeseries.resample(period_starts[devices == device], counts[devices == device], edges).tolist()
+            for device in sorted(set(devices))
+        }
+    return result
+
+def query_funnel(args):
+    """Get session conversion through an ordered list of events."""
+    config = current_app.config
+    funnel_name = args.get('funnel')
+    if funnel_name:
+        funnel = config['PRECOMPUTED_FUNNELS'].get(funnel_name)
+        if not funnel:
+            raise QueryError(f'Unknown funnel: {funnel_name}', 404)
+        steps = funnel['steps']
+        window = funnel.get('window', config['FUNNEL_DEFAULT_WINDOW'])
+    else:
+        steps = [step for step in args.get('steps', '').split(',') if step]
+        window = parse_int(args, 'window', config['FUNNEL_DEFAULT_WINDOW'])
+
+    if len(steps) < 2 or len(steps) > config['FUNNEL_MAX_STEPS']:
+        raise QueryError(f"steps must list between 2 and {config['FUNNEL_MAX_STEPS']} event names")
+    if any(a == b for a, b in zip(steps, steps[1:])):
+        raise QueryError('Consecutive funnel steps must be different events')
+    if window <= 0:
+        raise QueryError('window must be a positive number of seconds')
+
+    start_date, end_date = parse_date_range(args)
+
+    if funnel_name:
+        counts, source = _named_funnel_counts(funnel_name, steps, window, start_date, end_date)
+    else:
+        counts = compute_funnel(steps, window, start_date, end_date)
+        source = 'live'
+
+    return {
+        'status': 'success',
+        'source': source,
+        'window': window,
+        'data': [{
+            'event_name': step,
+            'count': count,
+            'conversion_rate': count / counts[0] if counts[0] else 0.0
+        } for step, count in zip(steps, counts)]
+    }
+
+def _named_funnel_counts(funnel_name, steps, window, start_date, end_date):
+    """Sum a named funnel's entries per day over [start_date, end_date).
+
+    Like the daily precomputed results, a session counts once for each day it
+    enters the funnel, and later steps may follow up to the window after that
+    day. Whole days are read from the precomputed results where present and
+    the rest, including partial days at the edges, computed live a day at a time.
+    Returns (counts, source).
+    """
+    first_day = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    results = {
+        result.period_start: result.step_counts
+        for result in FunnelResult.query.filter(
+            FunnelResult.funnel_name == funnel_name,
+            FunnelResult.period_start >= first_day,
+            FunnelResult.period_start < end_date
+        )
+    }
+
+    counts = [0] * len(steps)
+    precomputed = False
+    day = first_day
+    while day < end_date:
+        day_end = day + timedelta(days=1)
+        chunk_start, chunk_end = max(start_date, day), min(end_date, day_end)
+        step_counts = results.get(to_naive_utc(day)) if (chunk_start, chunk_end) == (day, day_end) else None
+        if step_counts is None:
+            step_counts = compute_funnel(steps, window, chunk_start,
+                                         chunk_end + timedelta(seconds=window), anchor_end=chunk_end)
+        else:
+            precomputed = True
+        counts = [total + count for total, count in zip(counts, step_counts)]
+        day = day_end
+    return counts, 'precomputed' if precomputed else 'live'
+
+def query_retention(args):
+    """Get the cohort retention matrix for sessions first seen in a period."""
+    start_date, end_date = parse_date_range(args, default='30d')
+    start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    max_offset = current_app.config['RETENTION_MAX_DAY_OFFSET']
+
+    cohorts = RetentionCohort.query.filter(
+        RetentionCohort.cohort_date >= start_date,
+        RetentionCohort.cohort_date <= end_date
+    ).order_by(
+        RetentionCohort.cohort_date,
+        RetentionCohort.day_offset
+    ).all()
+
+    matrix = {}
+    for cohort in cohorts:
+        row = matrix.setdefault(cohort.cohort_date, [0] * (max_offset + 1))
+        if cohort.day_offset <= max_offset:
+            row[cohort.day_offset] = cohort.sessions
+
+    return {
+        'status': 'success',
+        'data': [{
+            'cohort_date': cohort_date.date().isoformat(),
+            'sessions': row[0],
+            'retained': row[1:]
+        } for cohort_date, row in matrix.items()]
+    }
+
+# Query types accepted by the batch endpoint
+QUERIES = {
+    'overview': query_overview,
+    'event_counts': query_event_counts,
+    'top_events': query_top_events,
+    'timeseries': query_timeseries,
+    'funnel': query_funnel,
+    'retention': query_retention,
+}
+
+def run_batch(widgets, max_workers):
+    """Run several stats queries concurrently and return their results in order.
+
+    Identical queries (same type and params) are only executed once. Each query
+    runs in its own app context, and so its own session and pooled connection.
+    """
+    app = current_app._get_current_object()
+    keys = [
+        (widget['type'], tuple(sorted((name, str(value)) for name, value in widget.get('params', {}).items())))
+        for widget in widgets
+    ]
+    unique_keys = list(dict.fromkeys(keys))
+
+    def run(key):
+        query_type, params = key
+        with app.app_context():
+            try:
+                return 200, QUERIES[query_type](dict(params))
+            except QueryError as e:
+                return e.status_code, {'error': e.message}
+            except Exception as e:
+                return 500, {'error': 'Failed to run query', 'message': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_keys)))) as executor:
+        results = dict(zip(unique_keys, executor.map(run, unique_keys)))
+
+    return [{
+        'id': widget.get('id', index),
+        'status_code': results[key][0],
+        **results[key][1]
+    } for index, (widget, key) in enumerate(zip(widgets, keys))]
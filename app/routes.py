@@ -1,9 +1,12 @@
-from flask import Blueprint, request, jsonify, make_response
-from app.services import track_event, get_or_create_session, aggregate_events
-from app.models import UserSession, UserEvent, EventAggregate
-from datetime import datetime, timedelta, UTC
-from sqlalchemy import func, desc
-from app import db
+import time
+from flask import Blueprint, request, jsonify, make_response, current_app, url_for
+from app.services import (track_event, find_duplicate_event, get_or_create_session, aggregate_events,
+                          get_period_bounds, finish_aggregation_run)
+from app.models import AggregationRun
+from app.queries import QueryError
+from app.sampling import get_sampler
+from app.admission import admission_control, get_admission_pool, get_admission_pools, rejection_response
+from app import db, queries
 
 bp = Blueprint('main', __name__)
 
@@ -11,12 +14,28 @@ bp = Blueprint('main', __name__)
 def before_request():
     """Middleware to ensure session exists for all requests."""
     if not request.cookies.get('session_id'):
-        session = get_or_create_session()
+        # Creating the session is a database write, admitted like the request
+        # itself; routes outside the ingest and stats pools are not admitted
+        if request.path == '/events':
+            pool = get_admission_pool(current_app, 'ingest')
+        elif request.path.startswith('/stats/'):
+            pool = get_admission_pool(current_app, 'stats')
+        else:
+            pool = None
+        rejection = pool.acquire() if pool else None
+        if rejection:
+            return rejection_response(pool, rejection)
+        try:
+            session = get_or_create_session()
+        finally:
+            if pool:
+                pool.release()
         response = make_response()
         response.set_cookie('session_id', session.session_id, max_age=30*24*60*60)  # 30 days
         return response
 
 @bp.route('/events', methods=['POST'])
+@admission_control('ingest')
 def track_user_event():
     """Endpoint to track user events."""
     if not request.is_json:
@@ -39,243 +58,198 @@ def track_user_event():
             'required': required_fields
         }), 400
     
+    client_event_id = data.get('event_id')
+    if client_event_id is not None and (not isinstance(client_event_id, str) or not 0 < len(client_event_id) <= 64):
+        return jsonify({
+            'error': 'event_id must be a string of at most 64 characters'
+        }), 400
+    
+    # A retry of a stored event gets the original back whatever the sampler decides
+    original = find_duplicate_event(client_event_id)
+    if original:
+        return jsonify({
+            'status': 'duplicate',
+            'event_id': original.id,
+            'session_id': original.session_id,
+            'sample_rate': 1.0 / (original.sample_weight or 1.0)
+        }), 200
+    
+    keep, sample_rate = get_sampler(current_app).sample(data['event_type'], data['event_name'])
+    if not keep:
+        return jsonify({
+            'status': 'sampled_out',
+            'sample_rate': sample_rate
+        }), 202
+    
+    pool = get_admission_pool(current_app, 'ingest')
+    started = time.perf_counter()
     try:
-        event = track_event(
+        event, created = track_event(
             event_type=data['event_type'],
             event_name=data['event_name'],
-            event_data=data.get('event_data')
+            event_data=data.get('event_data'),
+            client_event_id=client_event_id,
+            sample_weight=1.0 / sample_rate
         )
         
         return jsonify({
-            'status': 'success',
+            'status': 'success' if created else 'duplicate',
             'event_id': event.id,
-            'session_id': event.session_id
-        }), 201
+            'session_id': event.session_id,
+            'sample_rate': sample_rate
+        }), 201 if created else 200
         
     except Exception as e:
         return jsonify({
             'error': 'Failed to track event',
             'message': str(e)
         }), 500
+    finally:
+        # Database latency drives the ingest concurrency limit
+        if pool is not None:
+            pool.observe_latency(time.perf_counter() - started)
+
+def _stats_response(query, args):
+    try:
+        return jsonify(query(args))
+    except QueryError as e:
+        return jsonify({'error': e.message}), e.status_code
 
 @bp.route('/stats/overview', methods=['GET'])
+@admission_control('stats')
 def get_overview_stats():
     """Get daily stats for a given period."""
-    range_type = request.args.get('range', '7d')
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 10))
-    
-    # Calculate date range
-    end_date = datetime.now(UTC)
-    if range_type == '7d':
-        start_date = end_date - timedelta(days=7)
-    elif range_type == '30d':
-        start_date = end_date - timedelta(days=30)
-    else:
-        # Custom range
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        if not start_date or not end_date:
-            return jsonify({'error': 'start_date and end_date required for custom range'}), 400
-        start_date = datetime.fromisoformat(start_date)
-        end_date = datetime.fromisoformat(end_date)
-
-    # Query daily aggregates
-    query = EventAggregate.query.filter(
-        EventAggregate.period_type == 'daily',
-        EventAggregate.period_start >= start_date,
-        EventAggregate.period_start <= end_date
-    )
-
-    # Apply filters
-    event_type = request.args.get('event_type')
-    device_type = request.args.get('device_type')
-    if event_type:
-        query = query.filter_by(event_type=event_type)
-    if device_type:
-        query = query.filter_by(device_type=device_type)
-
-    # Get total count for pagination
-    total = query.count()
-    
-    # Apply sorting
-    sort_by = request.args.get('sort_by', 'period_start')
-    sort_order = request.args.get('sort_order', 'desc')
-    if sort_order == 'desc':
-        query = query.order_by(desc(sort_by))
-    else:
-        query = query.order_by(sort_by)
-
-    # Apply pagination
-    paginated_query = query.paginate(page=page, per_page=per_page)
-    
-    return jsonify({
-        'status': 'success',
-        'data': [{
-            'date': agg.period_start.date().isoformat(),
-            'event_type': agg.event_type,
-            'event_name': agg.event_name,
-            'count': agg.count,
-            'device_type': agg.device_type
-        } for agg in paginated_query.items],
-        'pagination': {
-            'page': page,
-            'per_page': per_page,
-            'total': total,
-            'pages': paginated_query.pages
-        }
-    })
+    return _stats_response(queries.query_overview, request.args)
 
 @bp.route('/stats/event-counts', methods=['GET'])
+@admission_control('stats')
 def get_event_counts():
     """Get aggregated counts for specific events."""
-    event_name = request.args.get('event_name')
-    if not event_name:
-        return jsonify({'error': 'event_name is required'}), 400
+    return _stats_response(queries.query_event_counts, request.args)
 
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 10))
-    
-    # Calculate date range
-    range_type = request.args.get('range', '7d')
-    end_date = datetime.now(UTC)
-    if range_type == '7d':
-        start_date = end_date - timedelta(days=7)
-    elif range_type == '30d':
-        start_date = end_date - timedelta(days=30)
-    else:
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        if not start_date or not end_date:
-            return jsonify({'error': 'start_date and end_date required for custom range'}), 400
-        start_date = datetime.fromisoformat(start_date)
-        end_date = datetime.fromisoformat(end_date)
-
-    # Query aggregates
-    query = EventAggregate.query.filter(
-        EventAggregate.event_name == event_name,
-        EventAggregate.period_start >= start_date,
-        EventAggregate.period_start <= end_date
-    )
-
-    # Apply filters
-    event_type = request.args.get('event_type')
-    device_type = request.args.get('device_type')
-    if event_type:
-        query = query.filter_by(event_type=event_type)
-    if device_type:
-        query = query.filter_by(device_type=device_type)
-
-    # Get total count
-    total = query.count()
-    
-    # Apply sorting
-    sort_by = request.args.get('sort_by', 'period_start')
-    sort_order = request.args.get('sort_order', 'desc')
-    if sort_order == 'desc':
-        query = query.order_by(desc(sort_by))
-    else:
-        query = query.order_by(sort_by)
+@bp.route('/stats/top-events', methods=['GET'])
+@admission_control('stats')
+def get_top_events():
+    """Get top N most triggered events."""
+    return _stats_response(queries.query_top_events, request.args)
+
+@bp.route('/stats/timeseries', methods=['GET'])
+@admission_control('stats')
+def get_timeseries():
+    """Get a dense, gap-filled series of counts for an event."""
+    return _stats_response(queries.query_timeseries, request.args)
+
+@bp.route('/stats/funnel', methods=['GET'])
+@admission_control('stats')
+def get_funnel():
+    """Get session conversion through an ordered list of events."""
+    return _stats_response(queries.query_funnel, request.args)
+
+@bp.route('/stats/retention', methods=['GET'])
+@admission_control('stats')
+def get_retention():
+    """Get the cohort retention matrix for sessions first seen in a period."""
+    return _stats_response(queries.query_retention, request.args)
+
+@bp.route('/stats/batch', methods=['POST'])
+@admission_control('stats', slots=lambda: current_app.config['STATS_BATCH_MAX_WORKERS'])
+def get_batch_stats():
+    """Run several dashboard widget queries in one request."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('queries'), list):
+        return jsonify({'error': 'Request body must be a JSON object with a queries list'}), 400
+
+    widgets = data['queries']
+    max_queries = current_app.config['STATS_BATCH_MAX_QUERIES']
+    if not widgets or len(widgets) > max_queries:
+        return jsonify({'error': f'queries must contain between 1 and {max_queries} items'}), 400
+
+    for widget in widgets:
+        if not isinstance(widget, dict) or widget.get('type') not in queries.QUERIES:
+            return jsonify({
+                'error': 'Invalid query type',
+                'allowed': sorted(queries.QUERIES)
+            }), 400
+        if not isinstance(widget.get('params', {}), dict):
+            return jsonify({'error': 'params must be an object'}), 400
 
-    # Apply pagination
-    paginated_query = query.paginate(page=page, per_page=per_page)
-    
     return jsonify({
         'status': 'success',
-        'data': [{
-            'period_start': agg.period_start.isoformat(),
-            'period_type': agg.period_type,
-            'count': agg.count,
-            'device_type': agg.device_type
-        } for agg in paginated_query.items],
-        'pagination': {
-            'page': page,
-            'per_page': per_page,
-            'total': total,
-            'pages': paginated_query.pages
-        }
+        'results': queries.run_batch(widgets, current_app.config['STATS_BATCH_MAX_WORKERS'])
     })
 
-@bp.route('/stats/top-events', methods=['GET'])
-def get_top_events():
-    """Get top N most triggered events."""
-    limit = int(request.args.get('limit', 10))
-    range_type = request.args.get('range', '7d')
-    
-    # Calculate date range
-    end_date = datetime.now(UTC)
-    if range_type == '7d':
-        start_date = end_date - timedelta(days=7)
-    elif range_type == '30d':
-        start_date = end_date - timedelta(days=30)
-    else:
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        if not start_date or not end_date:
-            return jsonify({'error': 'start_date and end_date required for custom range'}), 400
-        start_date = datetime.fromisoformat(start_date)
-        end_date = datetime.fromisoformat(end_date)
+@bp.route('/metrics/sampling', methods=['GET'])
+def get_sampling_metrics():
+    """Get the current ingest sampling rate for each sampled event type."""
+    return jsonify({
+        'status': 'success',
+        'data': get_sampler(current_app).rates()
+    })
 
-    # Query top events
-    top_events = db.session.query(
-        EventAggregate.event_type,
-        EventAggregate.event_name,
-        func.sum(EventAggregate.count).label('total_count')
-    ).filter(
-        EventAggregate.period_start >= start_date,
-        EventAggregate.period_start <= end_date
-    ).group_by(
-        EventAggregate.event_type,
-        EventAggregate.event_name
-    ).order_by(
-        desc('total_count')
-    ).limit(limit).all()
-    
+@bp.route('/metrics/admission', methods=['GET'])
+def get_admission_metrics():
+    """Get concurrency, queue depth and latency for each admission pool."""
+    if not current_app.config['ADMISSION_CONTROL_ENABLED']:
+        return jsonify({'status': 'success', 'data': {}})
     return jsonify({
         'status': 'success',
-        'data': [{
-            'event_type': event.event_type,
-            'event_name': event.event_name,
-            'total_count': event.total_count
-        } for event in top_events]
+        'data': {name: pool.stats() for name, pool in get_admission_pools(current_app).items()}
     })
 
 @bp.route('/analytics/aggregate', methods=['POST'])
 def trigger_aggregation():
-    """Manually trigger event aggregation."""
+    """Queue event aggregation and return a run id to poll."""
     period_type = request.args.get('period_type', 'daily')
     
-    if period_type not in ['daily', 'weekly', 'monthly']:
+    if period_type not in ['hourly', 'daily', 'weekly', 'monthly']:
         return jsonify({
-            'error': 'Invalid period type. Must be one of: daily, weekly, monthly'
+            'error': 'Invalid period type. Must be one of: hourly, daily, weekly, monthly'
         }), 400
-        
+    
     try:
-        # Check if there are any events to aggregate
-        event_count = UserEvent.query.count()
-        if event_count == 0:
-            return jsonify({
-                'status': 'warning',
-                'message': 'No events found to aggregate'
-            }), 200
-            
-        # Run aggregation synchronously for testing
-        aggregate_events(period_type)
+        period_offset = int(request.args.get('period_offset', 0))
+    except ValueError:
+        return jsonify({'error': 'period_offset must be an integer'}), 400
+    if period_offset > 0:
+        return jsonify({'error': 'period_offset cannot be in the future'}), 400
         
-        # Verify aggregation results
-        aggregate_count = EventAggregate.query.filter_by(period_type=period_type).count()
+    period_start, _ = get_period_bounds(period_type, offset=period_offset)
+    run = AggregationRun(
+        period_type=period_type,
+        period_start=period_start,
+        status='queued'
+    )
+    db.session.add(run)
+    db.session.commit()
+    run_id = run.id
         
-        return jsonify({
-            'status': 'success',
-            'message': f'Aggregation completed for {period_type} period',
-            'period_type': period_type,
-            'total_events': event_count,
-            'aggregated_groups': aggregate_count
-        }), 200
+    try:
+        aggregate_events.apply_async(args=(period_type, period_offset), kwargs={'run_id': run_id})
     except Exception as e:
+        db.session.rollback()
+        finish_aggregation_run(run_id, 'failed', error=str(e))
+        db.session.commit()
         return jsonify({
             'error': 'Failed to trigger aggregation',
             'message': str(e)
         }), 500
-
-
+        
+    return jsonify({
+        'status': 'queued',
+        'message': f'Aggregation queued for {period_type} period',
+        'period_type': period_type,
+        'run_id': run_id,
+        'status_url': url_for('main.get_aggregation_run', run_id=run_id)
+    }), 202
+
+@bp.route('/analytics/aggregate/<int:run_id>', methods=['GET'])
+def get_aggregation_run(run_id):
+    """Get the status of an aggregation run."""
+    run = db.session.get(AggregationRun, run_id)
+    if not run:
+        return jsonify({'error': 'Aggregation run not found'}), 404
+    
+    return jsonify({
+        'status': 'success',
+        'data': run.to_dict()
+    })
@@ -0,0 +1,92 @@
+import math
+import time
+import random
+import threading
+
+class RateMeter:
+    """Exponentially decaying events-per-second estimate."""
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self.value = 0.0
+        self.updated_at = time.monotonic()
+
+    def _decay(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.value *= math.exp(-elapsed / self.window_seconds)
+            self.updated_at = now
+
+    def mark(self):
+        now = time.monotonic()
+        self._decay(now)
+        self.value += 1.0 / self.window_seconds
+
+    def rate(self):
+        self._decay(time.monotonic())
+        return self.value
+
+class Sampler:
+    """Decides which ingested events to keep, per event_type.
+
+    A rule is either static, {'rate': 0.1}, or adaptive,
+    {'target_per_second': 50, 'min_rate': 0.01}, in which case the rate is
+    lowered as the offered load for that event_type rises above the target.
+    Event types without a rule are always kept, as are the event names in
+    exempt_names.
+
+    Only event_aggregates are weighted. Funnels and retention cohorts read raw
+    events without weights, so sampled events under-count there; sample only
+    high volume event types they do not depend on. Steps of the precomputed
+    funnels are exempted automatically (see get_sampler).
+    """
+
+    def __init__(self, rules, window_seconds=10, exempt_names=()):
+        self.rules = rules
+        self.window_seconds = window_seconds
+        self.exempt_names = frozenset(exempt_names)
+        self.meters = {}
+        self._lock = threading.Lock()
+
+    def current_rate(self, event_type):
+        rule = self.rules.get(event_type)
+        if not rule:
+            return 1.0
+        if 'target_per_second' not in rule:
+            return rule.get('rate', 1.0)
+        meter = self.meters.get(event_type)
+        observed = meter.rate() if meter else 0.0
+        if observed <= rule['target_per_second']:
+            return 1.0
+        return max(rule.get('min_rate', 0.01), rule['target_per_second'] / observed)
+
+    def sample(self, event_type, event_name=None):
+        """Return (keep, rate) for one incoming event."""
+        if event_type not in self.rules or event_name in self.exempt_names:
+            return True, 1.0
+        with self._lock:
+            if event_type not in self.meters:
+                self.meters[event_type] = RateMeter(self.window_seconds)
+            self.meters[event_type].mark()
+            rate = self.current_rate(event_type)
+        return random.random() < rate, rate
+
+    def rates(self):
+        """Current sampling rate and offered load for every sampled event_type."""
+        with self._lock:
+            return {
+                event_type: {
+                    'sample_rate': self.current_rate(event_type),
+                    'observed_per_second': self.meters[event_type].rate() if event_type in self.meters else 0.0
+                } for event_type in self.rules
+            }
+
+def get_sampler(app):
+    """Return the app's sampler, built from EVENT_SAMPLING_RULES on first use."""
+    if 'event_sampler' not in app.extensions:
+        app.extensions['event_sampler'] = Sampler(
+            app.config['EVENT_SAMPLING_RULES'],
+            app.config['EVENT_SAMPLING_WINDOW_SECONDS'],
+            exempt_names={step for funnel in app.config['PRECOMPUTED_FUNNELS'].values() for step in funnel['steps']}
+        )
+    return app.extensions['event_sampler']
@@ -1,11 +1,19 @@
+import os
 import uuid
+import gzip
 from datetime import datetime, timedelta, UTC
-from flask import request
+from flask import request, current_app
 from app import db, celery
-from app.models import UserSession, UserEvent, EventAggregate
+from app.models import (UserSession, UserEvent, EventAggregate, EventDefinition, AggregationPeriod,
+                        FunnelResult, RetentionCohort, AggregationRun)
+from app.locks import LeaseLock, LeaseLostError
+from app.dedupe import get_event_id_filter
+from app.funnels import compute_funnel
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 import re
 import json
+from celery import group, chord
 from celery.schedules import crontab
 
 def get_or_create_session():
@@ -18,7 +26,7 @@ def get_or_create_session():
     
     # Create new session
     session = UserSession(
-        session_id=session_id,
+        session_id=session_id or str(uuid.uuid4()),
         ip_address=request.remote_addr,
         user_agent=request.user_agent.string,
         start_time=datetime.now(UTC)
@@ -27,102 +35,585 @@ def get_or_create_session():
     db.session.commit()
     return session
 
-def track_event(event_type, event_name, event_data=None):
-    """Track a user event."""
+def track_event(event_type, event_name, event_data=None, client_event_id=None, sample_weight=1.0):
+    """Track a user event.
+
+    Returns (event, created). Callers look up probable duplicates with
+    find_duplicate_event first; when the unique constraint still rejects the
+    client event id, the original event is returned with created=False.
+    """
     session = get_or_create_session()
+    event_filter = get_event_id_filter(current_app.config) if client_event_id else None
     
     event = UserEvent(
         session_id=session.session_id,
         event_type=event_type,
         event_name=event_name,
         event_data=json.dumps(event_data) if event_data else None,
-        timestamp=datetime.now(UTC)
+        timestamp=datetime.now(UTC),
+        client_event_id=client_event_id,
+        sample_weight=sample_weight
     )
     
     db.session.add(event)
-    db.session.commit()
-    return event
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if not client_event_id:
+            raise
+        original = UserEvent.query.filter_by(client_event_id=client_event_id).first()
+        if not original:
+            raise
+        event_filter.add(client_event_id)
+        return original, False
+    
+    if event_filter:
+        event_filter.add(client_event_id)
+    return event, True
+
+def find_duplicate_event(client_event_id):
+    """Return the stored event with this client event id, if the Bloom filter has probably seen it."""
+    if not client_event_id or not get_event_id_filter(current_app.config).might_contain(client_event_id):
+        return None
+    return UserEvent.query.filter_by(client_event_id=client_event_id).first()
 
 def get_device_type(user_agent):
     """Simple device detection from user agent."""
     mobile_pattern = re.compile(r'mobile|android|iphone|ipad|ipod', re.IGNORECASE)
     return 'mobile' if mobile_pattern.search(user_agent) else 'desktop'
 
+def get_period_bounds(period_type, now=None, offset=0):
+    """Return (start, end) of the period containing now, shifted by offset periods."""
+    now = now or datetime.now(UTC)
+    if period_type == 'hourly':
+        period_start = now.replace(minute=0, second=0, microsecond=0)
+        period_start += timedelta(hours=offset)
+        period_end = period_start + timedelta(hours=1)
+    elif period_type == 'daily':
+        period_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        period_start += timedelta(days=offset)
+        period_end = period_start + timedelta(days=1)
+    elif period_type == 'weekly':
+        # Start from the beginning of the week (Monday)
+        period_start = now - timedelta(days=now.weekday())
+        period_start = period_start.replace(hour=0, minute=0, second=0, microsecond=0)
+        period_start += timedelta(weeks=offset)
+        period_end = period_start + timedelta(weeks=1)
+    elif period_type == 'monthly':
+        # Start from the beginning of the month
+        month = now.year * 12 + now.month - 1 + offset
+        period_start = now.replace(year=month // 12, month=month % 12 + 1, day=1,
+                                   hour=0, minute=0, second=0, microsecond=0)
+        period_end = period_start.replace(year=(month + 1) // 12, month=(month + 1) % 12 + 1)
+    else:
+        raise ValueError(f"Unsupported period type: {period_type}")
+    return period_start, period_end
+
+def aggregation_lock(period_type, period_start, token=None):
+    """Lease lock guarding the aggregation of one period."""
+    return LeaseLock(
+        f'aggregate:{period_type}:{period_start.isoformat()}',
+        url=current_app.config['AGGREGATION_LOCK_URL'],
+        ttl=current_app.config['AGGREGATION_LOCK_TTL'],
+        token=token
+    )
+
 @celery.task
-def aggregate_events(period_type='daily'):
-    """Aggregate events into period buckets."""
+def aggregate_events(period_type='daily', period_offset=0, shards=None, run_id=None):
+    """Aggregate events into period buckets.
+
+    period_offset selects an earlier period (-1 is the previous one). Counts are
+    recomputed from the raw events, so re-running a period is idempotent, and a
+    period that has fully elapsed is recorded as finalized.
+
+    Each call is recorded in aggregation_runs (run_id continues a run created by
+    the API) and holds a lease lock on the period, so overlapping calls for the
+    same period are skipped rather than doing the work twice.
+
+    With more than one shard (AGGREGATION_SHARDS by default) the counting is
+    fanned out to aggregate_event_shard tasks and merged by
+    merge_event_aggregates; the resulting rows are the same as unsharded.
+    """
+    now = datetime.now(UTC)
+    period_start, period_end = get_period_bounds(period_type, now, period_offset)
+    shards = shards or current_app.config['AGGREGATION_SHARDS']
+    
+    run = db.session.get(AggregationRun, run_id) if run_id else None
+    if run is None:
+        run = AggregationRun(period_type=period_type, period_start=period_start)
+        db.session.add(run)
+    run.shards = shards
+    run.status = 'running'
+    run.started_at = now
+    
+    # Raw events before the cutoff may have been archived, so recounting a
+    # finalized period that reaches back that far would lower its counts
+    cutoff = retention_cutoff(now)
+    if cutoff is not None and period_start < cutoff and is_period_finalized(period_type, period_start):
+        run.status = 'skipped'
+        run.error = 'Period is finalized and its raw events may have been purged'
+        run.finished_at = datetime.now(UTC)
+        db.session.commit()
+        print(f"Skipping {period_type} aggregation for {period_start}: finalized and past retention")
+        return run.id
+    
+    # The dispatcher of a sharded run exits straight away; the shards and the
+    # merge step each hold the lease with a heartbeat while they run, and fail
+    # the run if it expired while they were queued
+    lock = aggregation_lock(period_type, period_start)
+    if not lock.acquire(heartbeat=shards == 1):
+        run.status = 'skipped'
+        run.error = 'Another aggregation of this period is in progress'
+        run.finished_at = datetime.now(UTC)
+        db.session.commit()
+        print(f"Skipping {period_type} aggregation for {period_start}: already running")
+        return run.id
+    db.session.commit()
+    
+    if shards > 1:
+        shard_by = current_app.config['AGGREGATION_SHARD_BY']
+        header = group(
+            aggregate_event_shard.s(period_start.isoformat(), period_end.isoformat(), shard, shards, shard_by,
+                                    period_type=period_type, lock_token=lock.token)
+            for shard in range(shards)
+        )
+        body = merge_event_aggregates.s(
+            period_type, period_start.isoformat(), period_end.isoformat(),
+            run_id=run.id, lock_token=lock.token
+        ).on_error(fail_aggregation_run.s(run.id, period_type, period_start.isoformat(), lock.token))
+        chord(header)(body)
+        print(f"Dispatched {shards} aggregation shards for {period_type} period starting at {period_start}")
+        return run.id
+    
     try:
-        # Get the start of the current period
-        now = datetime.now(UTC)
-        if period_type == 'daily':
-            period_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period_type == 'weekly':
-            # Start from the beginning of the week (Monday)
-            period_start = now - timedelta(days=now.weekday())
-            period_start = period_start.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period_type == 'monthly':
-            # Start from the beginning of the month
-            period_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        else:
-            raise ValueError(f"Unsupported period type: {period_type}")
+        event_groups = count_event_groups(period_start, period_end)
+        save_event_aggregates(period_type, period_start, period_end, event_groups, run.id, lock)
+    except Exception as e:
+        db.session.rollback()
+        finish_aggregation_run(run.id, 'failed', error=str(e))
+        db.session.commit()
+        raise e
+    finally:
+        lock.release()
+    return run.id
+
+@celery.task
+def aggregate_event_shard(period_start, period_end, shard, shards, shard_by='definition',
+                          period_type=None, lock_token=None):
+    """Count one shard of a period's events, returned as [definition_id, device_type, count, rows] rows."""
+    lock = aggregation_lock(period_type, datetime.fromisoformat(period_start), lock_token) if lock_token else None
+    if lock and not lock.hold():
+        raise LeaseLostError(f"Lost the {period_type} aggregation lease for {period_start} before shard {shard}")
+    try:
+        event_groups = count_event_groups(
+            datetime.fromisoformat(period_start),
+            datetime.fromisoformat(period_end),
+            shard, shards, shard_by
+        )
+        if lock:
+            lock.check()
+    finally:
+        if lock:
+            lock.stop_heartbeat()
+    return [[event_definition_id, device_type, count, rows]
+            for (event_definition_id, device_type), (count, rows) in event_groups.items()]
+
+@celery.task
+def merge_event_aggregates(partials, period_type, period_start, period_end, run_id=None, lock_token=None):
+    """Merge the partial counts from every shard and write them in one upsert."""
+    event_groups = {}
+    for partial in partials:
+        for event_definition_id, device_type, count, rows in partial:
+            key = (event_definition_id, device_type)
+            total_count, total_rows = event_groups.get(key, (0, 0))
+            event_groups[key] = (total_count + count, total_rows + rows)
+    
+    period_start = datetime.fromisoformat(period_start)
+    lock = aggregation_lock(period_type, period_start, lock_token) if lock_token else None
+    try:
+        if lock and not lock.hold():
+            raise LeaseLostError(f"Lost the {period_type} aggregation lease for {period_start} before merging")
+        return save_event_aggregates(
+            period_type,
+            period_start,
+            datetime.fromisoformat(period_end),
+            event_groups,
+            run_id,
+            lock
+        )
+    finally:
+        if lock:
+            lock.release()
+
+@celery.task
+def fail_aggregation_run(request, exc, traceback, run_id, period_type, period_start, lock_token):
+    """Error callback for a sharded run: record the failure and free the period."""
+    finish_aggregation_run(run_id, 'failed', error=str(exc))
+    db.session.commit()
+    aggregation_lock(period_type, datetime.fromisoformat(period_start), lock_token).release()
+
+def finish_aggregation_run(run_id, status, groups_written=None, rows_scanned=None, error=None):
+    """Record the outcome of an aggregation run."""
+    run = db.session.get(AggregationRun, run_id) if run_id else None
+    if run is None:
+        return
+    run.status = status
+    run.error = error
+    run.finished_at = datetime.now(UTC)
+    if groups_written is not None:
+        run.groups_written = groups_written
+        run.rows_scanned = rows_scanned
+
+def count_event_groups(period_start, period_end, shard=0, shards=1, shard_by='definition'):
+    """Count a period's events by (event_definition_id, device_type).
+
+    Each group maps to (count, rows): count is the sum of the events' sample
+    weights, an unbiased estimate of the number of events offered before
+    sampling, and rows is the number of stored events read. A shard covers
+    either the definitions whose id falls in it (ids are dense integers, so
+    this spreads event names evenly) or an equal slice of time.
+    """
+    # Count events per definition and user agent in the database rather than
+    # loading every event (and its session) into Python
+    query = db.session.query(
+        UserEvent.event_definition_id,
+        UserSession.user_agent,
+        func.sum(UserEvent.sample_weight),
+        func.count(UserEvent.id)
+    ).join(
+        UserSession, UserSession.session_id == UserEvent.session_id
+    )
+    
+    if shards > 1 and shard_by == 'time':
+        slice_length = (period_end - period_start) / shards
+        slice_start = period_start + slice_length * shard
+        slice_end = period_end if shard == shards - 1 else slice_start + slice_length
+        query = query.filter(
+            UserEvent.timestamp >= slice_start,
+            UserEvent.timestamp < slice_end
+        )
+    else:
+        query = query.filter(
+            UserEvent.timestamp >= period_start,
+            UserEvent.timestamp < period_end
+        )
+        if shards > 1:
+            query = query.filter(UserEvent.event_definition_id % shards == shard)
+    
+    rows = query.group_by(
+        UserEvent.event_definition_id,
+        UserSession.user_agent
+    ).all()
+    
+    # Group events by definition and device
+    event_groups = {}
+    for event_definition_id, user_agent, count, row_count in rows:
+        device_type = get_device_type(user_agent)
         
-        # Query events for aggregation
-        events = UserEvent.query.filter(
-            UserEvent.timestamp >= period_start
-        ).all()
+        key = (event_definition_id, device_type)
+        total_count, total_rows = event_groups.get(key, (0, 0))
+        event_groups[key] = (total_count + count, total_rows + row_count)
+    return event_groups
+
+def save_event_aggregates(period_type, period_start, period_end, event_groups, run_id=None, lock=None):
+    """Upsert the counted groups into event_aggregates and finalize elapsed periods.
+
+    Nothing is committed if the lease on the period was lost in the meantime.
+    """
+    now = datetime.now(UTC)
+    rows_scanned = sum(rows for _, rows in event_groups.values())
+    event_groups = {key: round(count) for key, (count, _) in event_groups.items()}
+    try:
+        upsert_event_aggregates(period_type, period_start, event_groups, now)
         
-        if not events:
-            print(f"No events found for period {period_type} starting at {period_start}")
-            return
+        if period_end <= now:
+            mark_period_finalized(period_type, period_start, now)
         
-        # Group events by type, name, and device
-        event_groups = {}
-        for event in events:
-            session = UserSession.query.filter_by(session_id=event.session_id).first()
-            if not session:
-                continue
-                
-            device_type = get_device_type(session.user_agent)
-            
-            key = (event.event_type, event.event_name, device_type)
-            if key not in event_groups:
-                event_groups[key] = 0
-            event_groups[key] += 1
+        finish_aggregation_run(run_id, 'succeeded', len(event_groups), rows_scanned)
+        if lock is not None:
+            lock.check()
+        db.session.commit()
         
-        # Create or update aggregates
-        for (event_type, event_name, device_type), count in event_groups.items():
-            # Check if aggregate already exists for this period
+        if not event_groups:
+            print(f"No events found for period {period_type} starting at {period_start}")
+        else:
+            print(f"Successfully aggregated {len(event_groups)} event groups for {period_type} period")
+        return len(event_groups)
+        
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error during aggregation: {str(e)}")
+        raise e
+
+def upsert_event_aggregates(period_type, period_start, event_groups, now, chunk_size=1000):
+    """Insert or overwrite aggregate counts with bulk INSERT ... ON CONFLICT statements."""
+    rows = [{
+        'event_definition_id': event_definition_id,
+        'period_type': period_type,
+        'period_start': period_start,
+        'device_type': device_type,
+        'count': count,
+        'created_at': now,
+        'updated_at': now
+    } for (event_definition_id, device_type), count in event_groups.items()]
+    
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        # No portable upsert, fall back to one lookup per group
+        for row in rows:
             aggregate = EventAggregate.query.filter_by(
-                event_type=event_type,
-                event_name=event_name,
+                event_definition_id=row['event_definition_id'],
                 period_type=period_type,
                 period_start=period_start,
-                device_type=device_type
+                device_type=row['device_type']
             ).first()
-            
             if aggregate:
-                # Update existing aggregate
-                aggregate.count += count
-                print(f"Updated aggregate for {event_type}/{event_name}: {count} events")
+                aggregate.count = row['count']
             else:
-                # Create new aggregate
-                aggregate = EventAggregate(
-                    event_type=event_type,
-                    event_name=event_name,
-                    period_type=period_type,
-                    period_start=period_start,
-                    count=count,
-                    device_type=device_type
-                )
-                db.session.add(aggregate)
-                print(f"Created new aggregate for {event_type}/{event_name}: {count} events")
+                db.session.add(EventAggregate(**row))
+        return
+    
+    for i in range(0, len(rows), chunk_size):
+        stmt = insert(EventAggregate.__table__).values(rows[i:i + chunk_size])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['event_definition_id', 'period_type', 'period_start', 'device_type'],
+            set_={'count': stmt.excluded.count, 'updated_at': stmt.excluded.updated_at}
+        )
+        db.session.execute(stmt)
+
+def mark_period_finalized(period_type, period_start, finalized_at):
+    """Record that the aggregates for a fully elapsed period are complete."""
+    period = AggregationPeriod.query.filter_by(
+        period_type=period_type,
+        period_start=period_start
+    ).first()
+    if not period:
+        period = AggregationPeriod(period_type=period_type, period_start=period_start)
+        db.session.add(period)
+    period.finalized_at = finalized_at
+
+def is_period_finalized(period_type, period_start):
+    """Check whether aggregates for a period have been finalized."""
+    return db.session.query(AggregationPeriod.id).filter(
+        AggregationPeriod.period_type == period_type,
+        AggregationPeriod.period_start == period_start,
+        AggregationPeriod.finalized_at.isnot(None)
+    ).first() is not None
+
+def retention_cutoff(now=None):
+    """Start of the earliest day whose raw events may have been purged for some event type."""
+    config = current_app.config
+    days = [config['EVENT_RETENTION_DAYS'], *config['EVENT_RETENTION_OVERRIDES'].values()]
+    days = [retention_days for retention_days in days if retention_days is not None]
+    if not days:
+        return None
+    today = (now or datetime.now(UTC)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=min(days))
+
+@celery.task
+def archive_events():
+    """Archive and purge raw events that are older than their retention period.
+
+    Events are written to compressed NDJSON files, one chunk per event type and
+    day, and then deleted in bounded batches. The rolled up event_aggregates are
+    kept, so a day is only purged once its hourly and daily aggregates and the
+    weekly and monthly aggregates containing it are finalized.
+    """
+    config = current_app.config
+    archive_dir = config['EVENT_ARCHIVE_DIR']
+    batch_size = config['EVENT_ARCHIVE_BATCH_SIZE']
+    today = datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    definitions_by_type = {}
+    for definition in EventDefinition.query.all():
+        definitions_by_type.setdefault(definition.event_type, []).append(definition)
+
+    archived = 0
+    for event_type, definitions in definitions_by_type.items():
+        retention_days = config['EVENT_RETENTION_OVERRIDES'].get(event_type, config['EVENT_RETENTION_DAYS'])
+        if retention_days is None:
+            continue
+        
+        cutoff = today - timedelta(days=retention_days)
+        names = {definition.id: definition.event_name for definition in definitions}
         
+        while True:
+            # Walk forward one day at a time from the oldest remaining event
+            oldest = db.session.query(func.min(UserEvent.timestamp)).filter(
+                UserEvent.event_definition_id.in_(names),
+                UserEvent.timestamp < cutoff
+            ).scalar()
+            if oldest is None:
+                break
+            
+            day_start, day_end = get_period_bounds('daily', oldest)
+            # Rollups are recomputed from raw events until they are finalized,
+            # so purging earlier would drop events from them
+            pending = [
+                period_type for period_type in ('daily', 'weekly', 'monthly')
+                if not is_period_finalized(period_type, get_period_bounds(period_type, oldest)[0])
+            ]
+            finalized_hours = db.session.query(func.count(AggregationPeriod.id)).filter(
+                AggregationPeriod.period_type == 'hourly',
+                AggregationPeriod.period_start >= day_start,
+                AggregationPeriod.period_start < day_end,
+                AggregationPeriod.finalized_at.isnot(None)
+            ).scalar()
+            if finalized_hours < 24:
+                pending.insert(0, 'hourly')
+            if pending:
+                print(f"Refusing to purge {event_type} events for {day_start.date()}: "
+                      f"{', '.join(pending)} aggregates not finalized")
+                break
+            
+            try:
+                event_ids = write_event_archive(archive_dir, event_type, names, day_start, day_end, batch_size)
+                archived += purge_events(event_ids, batch_size)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error archiving {event_type} events for {day_start.date()}: {str(e)}")
+                raise e
+            print(f"Archived {len(event_ids)} {event_type} events for {day_start.date()}")
+
+    return archived
+
+def write_event_archive(archive_dir, event_type, names, day_start, day_end, batch_size):
+    """Write one day of events to a gzipped NDJSON chunk and return their ids."""
+    query = db.session.query(
+        UserEvent.id,
+        UserEvent.event_definition_id,
+        UserEvent.session_id,
+        UserEvent.timestamp,
+        UserEvent.event_data,
+        UserEvent.client_event_id,
+        UserEvent.sample_weight,
+        UserEvent.created_at
+    ).filter(
+        UserEvent.event_definition_id.in_(names),
+        UserEvent.timestamp >= day_start,
+        UserEvent.timestamp < day_end
+    ).order_by(
+        UserEvent.timestamp,
+        UserEvent.id
+    ).execution_options(yield_per=batch_size)
+
+    directory = os.path.join(archive_dir, re.sub(r'[^\w.-]', '_', event_type), f'{day_start:%Y}')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{day_start:%Y-%m-%d}.ndjson.gz')
+    if os.path.exists(path):
+        # Keep earlier chunks (e.g. late arriving events) instead of overwriting them
+        path = os.path.join(directory, f'{day_start:%Y-%m-%d}.{int(datetime.now(UTC).timestamp())}.ndjson.gz')
+
+    event_ids = []
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        for row in query:
+            event_ids.append(row.id)
+            f.write(json.dumps({
+                'id': row.id,
+                'session_id': row.session_id,
+                'event_type': event_type,
+                'event_name': names[row.event_definition_id],
+                'timestamp': row.timestamp.isoformat(),
+                'event_data': row.event_data,
+                'client_event_id': row.client_event_id,
+                'sample_weight': row.sample_weight,
+                'created_at': row.created_at.isoformat() if row.created_at else None
+            }) + '\n')
+    os.replace(tmp_path, path)
+    return event_ids
+
+def purge_events(event_ids, batch_size):
+    """Delete events in small committed batches so no lock is held for long."""
+    deleted = 0
+    for i in range(0, len(event_ids), batch_size):
+        deleted += UserEvent.query.filter(
+            UserEvent.id.in_(event_ids[i:i + batch_size])
+        ).delete(synchronize_session=False)
         db.session.commit()
-        print(f"Successfully aggregated {len(event_groups)} event groups for {period_type} period")
+    return deleted
+
+@celery.task
+def precompute_funnels(period_offset=-1):
+    """Store daily step counts for the funnels configured in PRECOMPUTED_FUNNELS.
+
+    Sessions are attributed to the day they entered the funnel, so later steps
+    may fall up to the funnel window after the end of the day.
+    """
+    day_start, day_end = get_period_bounds('daily', offset=period_offset)
+    for funnel_name, funnel in current_app.config['PRECOMPUTED_FUNNELS'].items():
+        window = funnel.get('window', current_app.config['FUNNEL_DEFAULT_WINDOW'])
+        try:
+            step_counts = compute_funnel(
+                funnel['steps'], window, day_start,
+                day_end + timedelta(seconds=window), anchor_end=day_end
+            )
+            result = FunnelResult.query.filter_by(funnel_name=funnel_name, period_start=day_start).first()
+            if not result:
+                result = FunnelResult(funnel_name=funnel_name, period_start=day_start)
+                db.session.add(result)
+            result.step_counts = step_counts
+            db.session.commit()
+            print(f"Precomputed funnel {funnel_name} for {day_start.date()}: {step_counts}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error precomputing funnel {funnel_name}: {str(e)}")
+            raise e
+
+@celery.task
+def update_retention_cohorts(period_offset=-1):
+    """Update the cohort x day-offset retention matrix from a single day of events.
+
+    Only the row for each cohort that the day touches is written, so the task
+    reads one day of events regardless of how much history exists.
+    """
+    max_offset = current_app.config['RETENTION_MAX_DAY_OFFSET']
+    day_start, day_end = get_period_bounds('daily', offset=period_offset)
+    try:
+        counts = {0: UserSession.query.filter(
+            UserSession.start_time >= day_start,
+            UserSession.start_time < day_end
+        ).count()}
+        
+        # Sessions from earlier cohorts that were active on this day
+        returning = db.session.query(
+            UserSession.session_id,
+            UserSession.start_time
+        ).join(
+            UserEvent, UserEvent.session_id == UserSession.session_id
+        ).filter(
+            UserEvent.timestamp >= day_start,
+            UserEvent.timestamp < day_end,
+            UserSession.start_time >= day_start - timedelta(days=max_offset),
+            UserSession.start_time < day_start
+        ).distinct().all()
+        
+        naive_day_start = day_start.replace(tzinfo=None)
+        for _, start_time in returning:
+            cohort_start = start_time.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+            offset = (naive_day_start - cohort_start).days
+            counts[offset] = counts.get(offset, 0) + 1
+        
+        for offset in range(max_offset + 1):
+            cohort_date = day_start - timedelta(days=offset)
+            cohort = RetentionCohort.query.filter_by(cohort_date=cohort_date, day_offset=offset).first()
+            if not cohort:
+                if not counts.get(offset):
+                    continue
+                cohort = RetentionCohort(cohort_date=cohort_date, day_offset=offset)
+                db.session.add(cohort)
+            cohort.sessions = counts.get(offset, 0)
         
+        db.session.commit()
+        print(f"Updated retention cohorts for {day_start.date()}")
     except Exception as e:
         db.session.rollback()
-        print(f"Error during aggregation: {str(e)}")
+        print(f"Error updating retention cohorts: {str(e)}")
         raise e
 
 # Schedule periodic tasks
@@ -145,3 +636,45 @@ def setup_periodic_tasks(sender, **kwargs):
         crontab(day_of_month=1, hour=0, minute=0),
         aggregate_events.s('monthly')
     )
+    
+    # Keep the hour in progress current; the planner reads today from hours
+    sender.add_periodic_task(
+        crontab(minute='*/5'),
+        aggregate_events.s('hourly', 0)
+    )
+    
+    # Finalize the periods that just closed, after the last events have landed
+    sender.add_periodic_task(
+        crontab(minute=5),
+        aggregate_events.s('hourly', -1)
+    )
+    sender.add_periodic_task(
+        crontab(hour=0, minute=15),
+        aggregate_events.s('daily', -1)
+    )
+    sender.add_periodic_task(
+        crontab(day_of_week=1, hour=0, minute=15),
+        aggregate_events.s('weekly', -1)
+    )
+    sender.add_periodic_task(
+        crontab(day_of_month=1, hour=0, minute=15),
+        aggregate_events.s('monthly', -1)
+    )
+    
+    # Precompute configured funnels for the previous day
+    sender.add_periodic_task(
+        crontab(hour=1, minute=0),
+        precompute_funnels.s(-1)
+    )
+    
+    # Add the previous day to the retention cohort matrix
+    sender.add_periodic_task(
+        crontab(hour=0, minute=30),
+        update_retention_cohorts.s(-1)
+    )
+    
+    # Archive and purge expired raw events once the day has been finalized
+    sender.add_periodic_task(
+        crontab(hour=2, minute=0),
+        archive_events.s()
+    )
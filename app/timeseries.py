@@ -0,0 +1,59 @@
+from datetime import timedelta, UTC
+import numpy as np
+
+BUCKETS = ('day', 'week', 'month')
+
+# Aggregate period types that can be resampled into each bucket, coarsest first
+BUCKET_SOURCES = {
+    'day': ['daily'],
+    'week': ['weekly', 'daily'],
+    'month': ['monthly', 'daily'],
+}
+
+def bucket_start(value, bucket):
+    """Truncate a datetime to the start of its bucket."""
+    value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == 'week':
+        value -= timedelta(days=value.weekday())
+    elif bucket == 'month':
+        value = value.replace(day=1)
+    return value
+
+def bucket_edges(start_date, end_date, bucket):
+    """Return datetime64 bucket edges covering [start_date, end_date].
+
+    There is one more edge than there are buckets; the last edge is the end of
+    the bucket containing end_date.
+    """
+    first = np.datetime64(to_naive_utc(bucket_start(start_date, bucket)), 'D')
+    last = np.datetime64(to_naive_utc(bucket_start(end_date, bucket)), 'D')
+    if bucket == 'month':
+        first_month = first.astype('datetime64[M]')
+        last_month = last.astype('datetime64[M]')
+        edges = np.arange(first_month, last_month + 2, dtype='datetime64[M]')
+    else:
+        step = 7 if bucket == 'week' else 1
+        edges = np.arange(first, last + step + 1, step, dtype='datetime64[D]')
+    return edges.astype('datetime64[s]')
+
+def resample(period_starts, values, edges):
+    """Sum values into the buckets defined by edges, filling empty buckets with 0."""
+    if len(period_starts) == 0:
+        return np.zeros(len(edges) - 1, dtype=np.int64)
+    index = np.searchsorted(edges, period_starts, side='right') - 1
+    valid = (index >= 0) & (index < len(edges) - 1)
+    sums = np.bincount(index[valid], weights=values[valid], minlength=len(edges) - 1)
+    return sums.astype(np.int64)
+
+def to_datetime64(values):
+    """Convert a sequence of datetimes into a datetime64[s] array."""
+    return np.array([to_naive_utc(value) for value in values], dtype='datetime64[s]')
+
+def to_epoch_seconds(edges):
+    return edges[:-1].astype(np.int64).tolist()
+
+def to_naive_utc(value):
+    """Convert a datetime to naive UTC, the form timestamps are stored in."""
+    if value.tzinfo:
+        value = value.astimezone(UTC).replace(tzinfo=None)
+    return value
@@ -9,6 +9,71 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
     CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 10,
+        'max_overflow': 10,
+        'pool_pre_ping': True
+    }
+
+    # Batch stats endpoint
+    STATS_BATCH_MAX_QUERIES = 20
+    STATS_BATCH_MAX_WORKERS = 4
+
+    # In-memory columnar cache of recent event_aggregates for stats reads
+    AGGREGATE_CACHE_ENABLED = os.getenv('AGGREGATE_CACHE_ENABLED', 'false').lower() == 'true'
+    AGGREGATE_CACHE_DAYS = 90
+    AGGREGATE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    AGGREGATE_CACHE_REFRESH_SECONDS = 30
+
+    # Split aggregate_events across workers by 'definition' or 'time'
+    AGGREGATION_SHARDS = int(os.getenv('AGGREGATION_SHARDS', 1))
+    AGGREGATION_SHARD_BY = os.getenv('AGGREGATION_SHARD_BY', 'definition')
+
+    # Lease lock per aggregated period; None keeps the lock in-process
+    AGGREGATION_LOCK_URL = os.getenv('AGGREGATION_LOCK_URL', 'redis://localhost:6379/0')
+    AGGREGATION_LOCK_TTL = 60
+
+    # Deduplication of client supplied event ids: 'memory' or 'redis'
+    EVENT_DEDUPE_BACKEND = os.getenv('EVENT_DEDUPE_BACKEND', 'memory')
+    EVENT_DEDUPE_REDIS_URL = os.getenv('EVENT_DEDUPE_REDIS_URL', 'redis://localhost:6379/0')
+    EVENT_DEDUPE_CAPACITY = 1_000_000
+    EVENT_DEDUPE_ERROR_RATE = 0.01
+    EVENT_DEDUPE_ROTATION_SECONDS = 24 * 60 * 60
+
+    # Ingest sampling per event_type, static {'rate': 0.1} or adaptive
+    # {'target_per_second': 50, 'min_rate': 0.01}. Only aggregates are
+    # weighted: funnels and retention read raw events, so steps of
+    # PRECOMPUTED_FUNNELS are never sampled and other sampled types under-count
+    EVENT_SAMPLING_RULES = {}
+    EVENT_SAMPLING_WINDOW_SECONDS = 10
+
+    # Admission control per process: ingest and stats get separate pools so
+    # a slow database under ingest load cannot starve dashboard reads. A slot
+    # is one database connection; /stats/batch takes STATS_BATCH_MAX_WORKERS.
+    # The pools together stay within the engine pool of each process:
+    #   pool_size 10 + max_overflow 10 = 20 connections
+    #   12 ingest + 6 stats = 18, leaving 2 for /analytics and /metrics
+    ADMISSION_CONTROL_ENABLED = os.getenv('ADMISSION_CONTROL_ENABLED', 'true').lower() == 'true'
+    ADMISSION_POOLS = {
+        'ingest': {'max_concurrent': 12, 'max_queue': 32, 'queue_timeout': 0.5,
+                   'target_latency': 0.25, 'retry_after': 1},
+        'stats': {'max_concurrent': 6, 'max_queue': 16, 'queue_timeout': 2.0, 'retry_after': 5},
+    }
+
+    # Raw event retention; aggregates are kept indefinitely
+    EVENT_RETENTION_DAYS = int(os.getenv('EVENT_RETENTION_DAYS', 90))
+    EVENT_RETENTION_OVERRIDES = {}  # event_type -> days, None keeps forever
+    EVENT_ARCHIVE_DIR = os.getenv('EVENT_ARCHIVE_DIR', 'archive')
+    EVENT_ARCHIVE_BATCH_SIZE = 1000
+
+    # Funnels precomputed daily, e.g.
+    # {'checkout': {'steps': ['view_product', 'add_to_cart', 'checkout'], 'window': 3600}}
+    PRECOMPUTED_FUNNELS = {}
+    FUNNEL_MAX_STEPS = 10
+    FUNNEL_DEFAULT_WINDOW = 24 * 60 * 60
+
+    # Longest day offset tracked in the retention cohort matrix
+    RETENTION_MAX_DAY_OFFSET = 30
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -19,8 +84,11 @@ class ProductionConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SQLALCHEMY_ENGINE_OPTIONS = {}
     CELERY_BROKER_URL = 'memory://'
     CELERY_RESULT_BACKEND = 'cache+memory://'
+    CELERY_ALWAYS_EAGER = True
+    AGGREGATION_LOCK_URL = None
 
 config = {
     'development': DevelopmentConfig,
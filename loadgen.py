@@ -0,0 +1,238 @@
+"""Load generator for sizing ingest and stats capacity.
+
+Replays captured traffic or synthesizes a mix of ingest and stats calls,
+either in-process through the Flask test client or over HTTP against a
+running server, and reports throughput, latency percentiles and errors.
+
+    python loadgen.py --concurrency 16 --duration 30 --ramp-up 5
+    python loadgen.py --target http --url http://localhost:5000 --mix ingest=0.9,stats=0.1
+    python loadgen.py --replay traffic.jsonl --requests 5000
+
+A replay file holds one JSON request per line:
+    {"method": "POST", "path": "/events", "json": {"event_type": "click", "event_name": "buy"}}
+Lines without a method and path are skipped.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+EVENT_TYPES = {
+    'page_view': ['home', 'product', 'cart', 'checkout'],
+    'click': ['add_to_cart', 'buy_now', 'search', 'menu'],
+    'scroll': ['feed', 'product_list'],
+}
+STATS_PATHS = [
+    '/stats/overview?range=7d',
+    '/stats/top-events?range=7d&limit=10',
+    '/stats/event-counts?event_name=add_to_cart&range=30d',
+    '/stats/timeseries?event_name=home&range=30d',
+]
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('ingest', 'stats'):
+            raise argparse.ArgumentTypeError(f'Unknown request kind: {kind}')
+        mix[kind] = float(weight)
+    return mix
+
+def load_replay(path):
+    """Read replayable requests from an NDJSON capture, skipping other lines."""
+    requests, skipped = [], 0
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not isinstance(entry, dict) or 'method' not in entry or 'path' not in entry:
+                skipped += 1
+                continue
+            kind = 'ingest' if entry['path'].startswith('/events') else 'stats'
+            requests.append((kind, entry['method'].upper(), entry['path'], entry.get('json')))
+    return requests, skipped
+
+def synthesize(mix):
+    """Return one (kind, method, path, json) request drawn from the mix."""
+    kind = random.choices(list(mix), weights=list(mix.values()))[0]
+    if kind == 'stats':
+        return kind, 'GET', random.choice(STATS_PATHS), None
+    event_type = random.choice(list(EVENT_TYPES))
+    return kind, 'POST', '/events', {
+        'event_type': event_type,
+        'event_name': random.choice(EVENT_TYPES[event_type]),
+        'event_data': {'value': random.randint(1, 100)}
+    }
+
+class InProcessTarget:
+    """Sends requests through the Flask test client against a local database."""
+
+    def __init__(self, database_url):
+        from app import create_app, db
+        self.app = create_app('testing', SQLALCHEMY_DATABASE_URI=database_url)
+        with self.app.app_context():
+            db.create_all()
+
+    def client(self, worker):
+        client = self.app.test_client()
+        client.set_cookie('session_id', f'loadgen-{worker}')
+
+        def send(method, path, payload):
+            response = client.open(path, method=method, json=payload)
+            return response.status_code
+        return send
+
+class HttpTarget:
+    """Sends requests to a running server with urllib."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def client(self, worker):
+        headers = {'Content-Type': 'application/json', 'Cookie': f'session_id=loadgen-{worker}'}
+
+        def send(method, path, payload):
+            data = json.dumps(payload).encode('utf-8') if payload is not None else None
+            request = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as e:
+                return e.code
+        return send
+
+class Recorder:
+    """Collects per-kind latencies and status codes from all workers."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def record(self, kind, latency, status):
+        with self._lock:
+            self.latencies[kind].append(latency)
+            self.statuses[kind][status] += 1
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run(target, args, replay=None):
+    recorder = Recorder()
+    deadline = time.monotonic() + args.ramp_up + args.duration if args.requests is None else None
+    remaining = [args.requests]
+    position = [0]
+    counter_lock = threading.Lock()
+
+    def next_request():
+        with counter_lock:
+            if remaining[0] is not None:
+                if remaining[0] <= 0:
+                    return None
+                remaining[0] -= 1
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            if replay:
+                if args.shuffle:
+                    return random.choice(replay)
+                position[0] += 1
+                return replay[(position[0] - 1) % len(replay)]
+        return synthesize(args.mix)
+
+    def worker(number):
+        # Spread worker start times evenly over the ramp-up period
+        time.sleep(args.ramp_up * number / max(1, args.concurrency))
+        send = target.client(number)
+        while True:
+            request = next_request()
+            if request is None:
+                return
+            kind, method, path, payload = request
+            started = time.perf_counter()
+            try:
+                status = send(method, path, payload)
+            except Exception:
+                status = 'error'
+            recorder.record(kind, time.perf_counter() - started, status)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.monotonic() - started
+
+def report(recorder, elapsed):
+    total = sum(len(values) for values in recorder.latencies.values())
+    print(f'{total} requests in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f} req/s)')
+    print(f"{'kind':<8} {'count':>7} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+    for kind, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        statuses = recorder.statuses[kind]
+        errors = sum(count for status, count in statuses.items() if status == 'error' or status >= 500)
+        print(f'{kind:<8} {len(values):>7} {len(values) / elapsed:>8.1f} '
+              f'{percentile(values, 0.5) * 1000:>8.1f} {percentile(values, 0.9) * 1000:>8.1f} '
+              f'{percentile(values, 0.99) * 1000:>8.1f} {values[-1] * 1000:>8.1f} '
+              f'{errors / len(values):>6.1%}')
+        print('         statuses: ' + ', '.join(
+            f'{status}={count}' for status, count in sorted(statuses.items(), key=str)
+        ))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate ingest and stats load against the analytics app.')
+    parser.add_argument('--target', choices=['inprocess', 'http'], default='inprocess')
+    parser.add_argument('--url', default='http://localhost:5000', help='server for the http target')
+    parser.add_argument('--database-url', help='database for the inprocess target (default: temporary SQLite file)')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of worker threads')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run after ramp-up')
+    parser.add_argument('--requests', type=int, help='stop after this many requests instead of a duration')
+    parser.add_argument('--ramp-up', type=float, default=0, help='seconds over which workers are started')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('ingest=0.8,stats=0.2'),
+                        help='weights of synthesized request kinds, e.g. ingest=0.8,stats=0.2')
+    parser.add_argument('--replay', help='NDJSON file of captured requests to replay')
+    parser.add_argument('--shuffle', action='store_true', help='replay requests in random order')
+    parser.add_argument('--seed', type=int, help='random seed for repeatable runs')
+    args = parser.parse_args(argv)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    replay = None
+    if args.replay:
+        replay, skipped = load_replay(args.replay)
+        if skipped:
+            print(f'Skipped {skipped} lines without a method and path in {args.replay}')
+        if not replay:
+            print('Nothing to replay')
+            return 1
+
+    if args.target == 'http':
+        target = HttpTarget(args.url)
+    else:
+        database_url = args.database_url
+        if not database_url:
+            database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='loadgen-'), 'loadgen.db')
+        target = InProcessTarget(database_url)
+
+    recorder, elapsed = run(target, args, replay)
+    report(recorder, elapsed)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Add event definitions
+
+Revision ID: 3f7a2c91b6d4
+Revises: e8dae4d58a2c
+Create Date: 2025-06-02 10:42:17.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f7a2c91b6d4'
+down_revision = 'e8dae4d58a2c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('event_definitions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('event_type', sa.String(length=50), nullable=False),
+    sa.Column('event_name', sa.String(length=100), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('event_type', 'event_name', name='unique_event_definition')
+    )
+
+    # Collect every distinct (event_type, event_name) already stored
+    op.execute("""
+        INSERT INTO event_definitions (event_type, event_name, created_at)
+        SELECT event_type, event_name, MIN(created_at) FROM (
+            SELECT event_type, event_name, created_at FROM user_events
+            UNION ALL
+            SELECT event_type, event_name, created_at FROM event_aggregates
+        ) AS names
+        GROUP BY event_type, event_name
+    """)
+
+    for table in ('user_events', 'event_aggregates'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('event_definition_id', sa.Integer(), nullable=True))
+
+        op.execute(f"""
+            UPDATE {table} SET event_definition_id = (
+                SELECT d.id FROM event_definitions d
+                WHERE d.event_type = {table}.event_type
+                AND d.event_name = {table}.event_name
+            )
+        """)
+
+    with op.batch_alter_table('event_aggregates') as batch_op:
+        batch_op.drop_constraint('unique_event_aggregate', type_='unique')
+
+    for table in ('user_events', 'event_aggregates'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('event_definition_id', existing_type=sa.Integer(), nullable=False)
+            batch_op.create_foreign_key(f'fk_{table}_event_definition_id', 'event_definitions',
+                                        ['event_definition_id'], ['id'])
+            batch_op.create_index(f'ix_{table}_event_definition_id', ['event_definition_id'], unique=False)
+            batch_op.drop_column('event_type')
+            batch_op.drop_column('event_name')
+
+    with op.batch_alter_table('event_aggregates') as batch_op:
+        batch_op.create_unique_constraint('unique_event_aggregate',
+                                          ['event_definition_id', 'period_type', 'period_start', 'device_type'])
+
+
+def downgrade():
+    with op.batch_alter_table('event_aggregates') as batch_op:
+        batch_op.drop_constraint('unique_event_aggregate', type_='unique')
+
+    for table in ('user_events', 'event_aggregates'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('event_type', sa.String(length=50), nullable=True))
+            batch_op.add_column(sa.Column('event_name', sa.String(length=100), nullable=True))
+
+        op.execute(f"""
+            UPDATE {table} SET
+                event_type = (SELECT d.event_type FROM event_definitions d WHERE d.id = {table}.event_definition_id),
+                event_name = (SELECT d.event_name FROM event_definitions d WHERE d.id = {table}.event_definition_id)
+        """)
+
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('event_type', existing_type=sa.String(length=50), nullable=False)
+            batch_op.alter_column('event_name', existing_type=sa.String(length=100), nullable=False)
+            batch_op.drop_index(f'ix_{table}_event_definition_id')
+            batch_op.drop_constraint(f'fk_{table}_event_definition_id', type_='foreignkey')
+            batch_op.drop_column('event_definition_id')
+
+    with op.batch_alter_table('event_aggregates') as batch_op:
+        batch_op.create_unique_constraint('unique_event_aggregate',
+                                          ['event_type', 'event_name', 'period_type', 'period_start', 'device_type'])
+
+    op.drop_table('event_definitions')
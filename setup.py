@@ -12,6 +12,7 @@ setup(
         'psycopg2-binary',
         'celery',
         'redis',
-        'python-dotenv'
+        'python-dotenv',
+        'numpy'
     ],
 ) 
\ No newline at end of file
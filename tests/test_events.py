@@ -1,7 +1,20 @@
+import gzip
+import json
+import random
 import pytest
 from datetime import datetime, timedelta, UTC
 from app import create_app, db
-from app.models import UserSession, UserEvent, EventAggregate
+from app.models import (UserSession, UserEvent, EventAggregate, EventDefinition, AggregationRun,
+                        AggregationPeriod, FunnelResult)
+from app.admission import get_admission_pools
+from app.column_cache import AggregateColumnCache, ROW_BYTES
+from app.dedupe import RotatingBloomFilter
+from app.locks import LeaseLostError
+from app.planner import plan_rollups
+from app.services import aggregation_lock, get_period_bounds
+# Tasks are reached through the module: pytest inspects module level names
+# during collection, which would finalize Celery before create_app configures it
+from app import services
 
 @pytest.fixture
 def app():
@@ -122,8 +135,8 @@ def test_get_top_events(client, app):
         aggregate = EventAggregate(
             event_type='click',
             event_name='test_button',
-            period_type='daily',
-            period_start=datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0),
+            period_type='hourly',
+            period_start=datetime.now(UTC).replace(minute=0, second=0, microsecond=0),
             count=5,
             device_type='desktop'
         )
@@ -155,11 +168,19 @@ def test_aggregation_trigger(client, app):
 
     # Test aggregation
     response = client.post('/analytics/aggregate?period_type=daily')
-    assert response.status_code == 200
+    assert response.status_code == 202
     data = response.get_json()
     assert data is not None
-    assert 'status' in data
-    assert data['status'] == 'success'
+    assert data['status'] == 'queued'
+    assert 'run_id' in data
+
+    # Poll the run
+    response = client.get(data['status_url'])
+    assert response.status_code == 200
+    run = response.get_json()['data']
+    assert run['status'] == 'succeeded'
+    assert run['rows_scanned'] == 1
+    assert run['groups_written'] == 1
 
 def test_invalid_date_range(client):
     """Test invalid date range in stats endpoints."""
@@ -191,4 +212,660 @@ def test_pagination(client, app):
     data = response.get_json()
     assert data is not None
     assert len(data['data']) == 10
-    assert data['pagination']['pages'] == 2 
\ No newline at end of file
+    assert data['pagination']['pages'] == 2 
+
+def test_event_definitions_are_shared(client, app):
+    """Test that repeated event names resolve to a single definition."""
+    for _ in range(3):
+        response = client.post('/events', json={
+            'event_type': 'click',
+            'event_name': 'test_button'
+        })
+        assert response.status_code == 201
+
+    with app.app_context():
+        assert EventDefinition.query.count() == 1
+        events = UserEvent.query.all()
+        assert len(events) == 3
+        assert len({event.event_definition_id for event in events}) == 1
+        assert events[0].event_type == 'click'
+        assert events[0].event_name == 'test_button'
+
+def test_aggregation_groups_by_definition(client, app):
+    """Test that aggregation counts events per definition and device."""
+    with app.app_context():
+        for name in ['test_button', 'test_button', 'other_button']:
+            db.session.add(UserEvent(
+                session_id='test-session',
+                event_type='click',
+                event_name=name,
+                timestamp=datetime.now(UTC)
+            ))
+        db.session.commit()
+
+    response = client.post('/analytics/aggregate?period_type=hourly')
+    assert response.status_code == 202
+
+    response = client.get('/stats/top-events?limit=5&range=7d')
+    data = response.get_json()
+    assert [(event['event_name'], event['total_count']) for event in data['data']] == [
+        ('test_button', 2),
+        ('other_button', 1)
+    ]
+
+def test_archive_events(client, app, tmp_path):
+    """Test that expired events are archived and purged once finalized."""
+    app.config['EVENT_ARCHIVE_DIR'] = str(tmp_path)
+    old_day = (datetime.now(UTC) - timedelta(days=100)).replace(hour=12, minute=0, second=0, microsecond=0)
+    with app.app_context():
+        for _ in range(2):
+            db.session.add(UserEvent(
+                session_id='test-session',
+                event_type='click',
+                event_name='test_button',
+                timestamp=old_day
+            ))
+        db.session.add(UserEvent(
+            session_id='test-session',
+            event_type='click',
+            event_name='test_button',
+            timestamp=datetime.now(UTC)
+        ))
+        db.session.commit()
+
+        # Not finalized yet, so nothing is purged
+        assert services.archive_events() == 0
+        assert UserEvent.query.count() == 3
+
+        now = datetime.now(UTC)
+        first_hour = (old_day.replace(hour=0) - get_period_bounds('hourly', now)[0]) // timedelta(hours=1)
+        services.aggregate_events('daily', -100)
+        for hour in range(23):
+            services.aggregate_events('hourly', first_hour + hour)
+        # An hour of the day, and the week and month containing it, are still open
+        assert services.archive_events() == 0
+
+        services.aggregate_events('hourly', first_hour + 23)
+        weeks = (get_period_bounds('weekly', old_day)[0] - get_period_bounds('weekly', now)[0]).days // 7
+        services.aggregate_events('weekly', weeks)
+        services.aggregate_events('monthly', old_day.year * 12 + old_day.month - now.year * 12 - now.month)
+        assert services.archive_events() == 2
+        assert UserEvent.query.count() == 1
+
+        # Recounting the purged day would overwrite its aggregates with zeros
+        run = db.session.get(AggregationRun, services.aggregate_events('daily', -100))
+        assert run.status == 'skipped'
+        assert EventAggregate.query.filter_by(period_type='daily').one().count == 2
+
+    archive = tmp_path / 'click' / f'{old_day:%Y}' / f'{old_day:%Y-%m-%d}.ndjson.gz'
+    with gzip.open(archive, 'rt') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 2
+    assert records[0]['event_name'] == 'test_button'
+    assert records[0]['sample_weight'] == 1.0
+
+def test_get_funnel(client, app):
+    """Test funnel conversion across ordered steps."""
+    now = datetime.now(UTC)
+    with app.app_context():
+        db.session.add(UserSession(session_id='other-session', ip_address='127.0.0.1', user_agent='test-agent'))
+        steps = [
+            ('test-session', 'view_product', 0),
+            ('test-session', 'add_to_cart', 60),
+            ('test-session', 'checkout', 120),
+            ('other-session', 'view_product', 0),
+            ('other-session', 'checkout', 30),
+            ('other-session', 'add_to_cart', 7200),
+        ]
+        for session_id, name, offset in steps:
+            db.session.add(UserEvent(
+                session_id=session_id,
+                event_type='click',
+                event_name=name,
+                timestamp=now - timedelta(hours=3) + timedelta(seconds=offset)
+            ))
+        db.session.commit()
+
+    response = client.get('/stats/funnel?steps=view_product,add_to_cart,checkout&window=3600')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [step['count'] for step in data['data']] == [2, 1, 1]
+    assert data['data'][1]['conversion_rate'] == 0.5
+
+    response = client.get('/stats/funnel?steps=view_product')
+    assert response.status_code == 400
+
+def test_named_funnel_precomputed_matches_live(client, app):
+    """Test that named funnels count per-day entries whether precomputed or live."""
+    app.config['PRECOMPUTED_FUNNELS'] = {'cart': {'steps': ['view_product', 'add_to_cart'], 'window': 3600}}
+    now = datetime.now(UTC).replace(tzinfo=None)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = today - timedelta(days=2) + timedelta(hours=12)
+    with app.app_context():
+        events = [
+            ('early-session', 'view_product', start - timedelta(hours=6)),
+            ('test-session', 'view_product', start + timedelta(hours=6)),
+            ('test-session', 'add_to_cart', start + timedelta(hours=6, minutes=5)),
+            ('other-session', 'view_product', today - timedelta(hours=14)),
+            ('third-session', 'view_product', today),
+            # Enters the funnel on three days, so counts once on each
+            ('multi-session', 'view_product', start + timedelta(hours=7)),
+            ('multi-session', 'view_product', today - timedelta(hours=13)),
+            ('multi-session', 'view_product', today),
+        ]
+        for session_id in {session_id for session_id, _, _ in events} - {'test-session'}:
+            db.session.add(UserSession(session_id=session_id, ip_address='127.0.0.1', user_agent='test-agent'))
+        for session_id, name, timestamp in events:
+            db.session.add(UserEvent(session_id=session_id, event_type='click', event_name=name, timestamp=timestamp))
+        db.session.commit()
+        services.precompute_funnels(-1)
+
+    url = f'/stats/funnel?funnel=cart&range=custom&start_date={start.isoformat()}' \
+          f'&end_date={(now + timedelta(minutes=1)).isoformat()}'
+    data = client.get(url).get_json()
+    assert data['source'] == 'precomputed'
+    assert [step['count'] for step in data['data']] == [6, 1]
+
+    with app.app_context():
+        FunnelResult.query.delete()
+        db.session.commit()
+    data = client.get(url).get_json()
+    assert data['source'] == 'live'
+    assert [step['count'] for step in data['data']] == [6, 1]
+
+def test_get_retention(client, app):
+    """Test the retention matrix built from daily cohort updates."""
+    two_days_ago = (datetime.now(UTC) - timedelta(days=2)).replace(hour=10, minute=0, second=0, microsecond=0)
+    with app.app_context():
+        for session_id in ['cohort-a', 'cohort-b']:
+            db.session.add(UserSession(
+                session_id=session_id,
+                ip_address='127.0.0.1',
+                user_agent='test-agent',
+                start_time=two_days_ago
+            ))
+        db.session.add(UserEvent(
+            session_id='cohort-a',
+            event_type='page_view',
+            event_name='home',
+            timestamp=two_days_ago + timedelta(days=1)
+        ))
+        db.session.commit()
+
+        services.update_retention_cohorts(-2)
+        services.update_retention_cohorts(-1)
+
+    response = client.get('/stats/retention?range=7d')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert len(data['data']) == 1
+    cohort = data['data'][0]
+    assert cohort['cohort_date'] == two_days_ago.date().isoformat()
+    assert cohort['sessions'] == 2
+    assert cohort['retained'][0] == 1
+
+def test_get_timeseries(client, app):
+    """Test gap-filled time series resampled from daily aggregates."""
+    this_hour = datetime.now(UTC).replace(minute=0, second=0, microsecond=0)
+    today = this_hour.replace(hour=0)
+    with app.app_context():
+        # Today is only covered by hourly rollups until it is finalized
+        rows = [('hourly', this_hour, 'desktop', 3), ('hourly', this_hour, 'mobile', 2),
+                ('daily', today, 'desktop', 1), ('daily', today - timedelta(days=2), 'desktop', 4)]
+        for period_type, period_start, device_type, count in rows:
+            db.session.add(EventAggregate(
+                event_type='click',
+                event_name='test_button',
+                period_type=period_type,
+                period_start=period_start,
+                count=count,
+                device_type=device_type
+            ))
+        db.session.commit()
+
+    response = client.get('/stats/timeseries?event_name=test_button&range=7d&group_by=device_type')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['source_period_type'] == 'daily'
+    assert len(data['timestamps']) == len(data['values']) == 8
+    assert data['values'][-3:] == [4, 0, 5]
+    assert data['series']['mobile'][-1] == 2
+    assert data['timestamps'][-1] == int(today.timestamp())
+
+    response = client.get('/stats/timeseries?event_name=test_button&bucket=year')
+    assert response.status_code == 400
+
+def test_timeseries_reads_in_progress_bucket_from_daily(client, app):
+    """Test that the current week is read through the planner, not its stale weekly or daily rows."""
+    today = datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    this_week = today - timedelta(days=today.weekday())
+    with app.app_context():
+        for weeks_ago in range(1, 6):
+            db.session.add(AggregationPeriod(
+                period_type='weekly',
+                period_start=this_week - timedelta(weeks=weeks_ago),
+                finalized_at=datetime.now(UTC)
+            ))
+        this_hour = datetime.now(UTC).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+        rows = [('weekly', this_week - timedelta(weeks=1), 7), ('weekly', this_week, 1),
+                ('daily', today, 1), ('hourly', this_hour, 5)]
+        for period_type, period_start, count in rows:
+            db.session.add(EventAggregate(
+                event_type='click',
+                event_name='test_button',
+                period_type=period_type,
+                period_start=period_start,
+                count=count,
+                device_type='desktop'
+            ))
+        db.session.commit()
+
+    data = client.get('/stats/timeseries?event_name=test_button&range=30d&bucket=week').get_json()
+    assert data['source_period_type'] == 'weekly'
+    assert data['values'][-2:] == [7, 5]
+
+def test_batch_stats(client, app):
+    """Test running several widget queries in one request."""
+    with app.app_context():
+        this_hour = datetime.now(UTC).replace(minute=0, second=0, microsecond=0)
+        for period_type, period_start in [('daily', this_hour.replace(hour=0)), ('hourly', this_hour)]:
+            db.session.add(EventAggregate(
+                event_type='click',
+                event_name='test_button',
+                period_type=period_type,
+                period_start=period_start,
+                count=5,
+                device_type='desktop'
+            ))
+        db.session.commit()
+
+    response = client.post('/stats/batch', json={'queries': [
+        {'id': 'overview', 'type': 'overview', 'params': {'range': '7d'}},
+        {'id': 'top', 'type': 'top_events', 'params': {'limit': 5}},
+        {'id': 'top-again', 'type': 'top_events', 'params': {'limit': '5'}},
+        {'id': 'counts', 'type': 'event_counts', 'params': {}}
+    ]})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [result['id'] for result in results] == ['overview', 'top', 'top-again', 'counts']
+    assert results[0]['pagination']['total'] == 1
+    assert results[1]['data'] == results[2]['data']
+    assert results[1]['data'][0]['total_count'] == 5
+    assert results[3]['status_code'] == 400
+
+    response = client.post('/stats/batch', json={'queries': [{'type': 'unknown'}]})
+    assert response.status_code == 400
+
+def test_sharded_aggregation_matches_unsharded(client, app):
+    """Test that merging shard partials gives the same aggregates."""
+    now = datetime.now(UTC)
+    with app.app_context():
+        for i in range(12):
+            db.session.add(UserEvent(
+                session_id='test-session',
+                event_type='click',
+                event_name=f'button_{i % 5}',
+                timestamp=now - timedelta(minutes=i)
+            ))
+        db.session.commit()
+
+        services.aggregate_events('daily', shards=1)
+        expected = {(agg.event_name, agg.device_type): agg.count for agg in EventAggregate.query.all()}
+        EventAggregate.query.delete()
+        db.session.commit()
+
+        period_start, period_end = get_period_bounds('daily', now)
+        for shard_by in ['definition', 'time']:
+            partials = [
+                services.aggregate_event_shard(period_start.isoformat(), period_end.isoformat(), shard, 3, shard_by)
+                for shard in range(3)
+            ]
+            services.merge_event_aggregates(partials, 'daily', period_start.isoformat(), period_end.isoformat())
+            merged = {(agg.event_name, agg.device_type): agg.count for agg in EventAggregate.query.all()}
+            assert merged == expected
+
+def test_aggregation_skips_locked_period(client, app):
+    """Test that a period already being aggregated is not aggregated twice."""
+    with app.app_context():
+        period_start, _ = get_period_bounds('daily')
+        lock = aggregation_lock('daily', period_start)
+        assert lock.acquire()
+        try:
+            run_id = services.aggregate_events('daily')
+        finally:
+            lock.release()
+
+        run = db.session.get(AggregationRun, run_id)
+        assert run.status == 'skipped'
+
+        run = db.session.get(AggregationRun, services.aggregate_events('daily'))
+        assert run.status == 'succeeded'
+
+def test_sharded_aggregation_aborts_on_lost_lease(client, app):
+    """Test that shards and the merge step refuse to work once the lease is gone."""
+    with app.app_context():
+        db.session.add(UserEvent(session_id='test-session', event_type='click', event_name='test_button'))
+        period_start, period_end = get_period_bounds('daily')
+        run = AggregationRun(period_type='daily', period_start=period_start, status='running', shards=2)
+        db.session.add(run)
+        db.session.commit()
+
+        # The lease expires (here: is dropped) while the chord sits in the queue
+        lock = aggregation_lock('daily', period_start)
+        assert lock.acquire(heartbeat=False)
+        lock.release()
+
+        with pytest.raises(LeaseLostError):
+            services.aggregate_event_shard(period_start.isoformat(), period_end.isoformat(), 0, 2,
+                                  period_type='daily', lock_token=lock.token)
+        with pytest.raises(LeaseLostError) as e:
+            services.merge_event_aggregates([[[1, 'desktop', 1, 1]]], 'daily', period_start.isoformat(),
+                                   period_end.isoformat(), run_id=run.id, lock_token=lock.token)
+        assert EventAggregate.query.count() == 0
+
+        services.fail_aggregation_run(None, e.value, None, run.id, 'daily', period_start.isoformat(), lock.token)
+        assert db.session.get(AggregationRun, run.id).status == 'failed'
+
+def test_track_event_duplicate_event_id(client, app):
+    """Test that a retried event id returns the original event."""
+    payload = {
+        'event_type': 'click',
+        'event_name': 'test_button',
+        'event_id': 'client-event-1'
+    }
+    response = client.post('/events', json=payload)
+    assert response.status_code == 201
+    original_id = response.get_json()['event_id']
+
+    response = client.post('/events', json=payload)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['status'] == 'duplicate'
+    assert data['event_id'] == original_id
+
+    with app.app_context():
+        assert UserEvent.query.count() == 1
+
+def test_bloom_filter():
+    """Test that the Bloom filter never misses an added key."""
+    bloom = RotatingBloomFilter(capacity=1000, error_rate=0.01, rotation_seconds=3600)
+    keys = [f'event-{i}' for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(bloom.might_contain(key) for key in keys)
+    false_positives = sum(bloom.might_contain(f'other-{i}') for i in range(1000))
+    assert false_positives < 50
+
+def test_track_event_duplicate_missed_by_filter(client, app):
+    """Test that the unique constraint catches duplicates the filter has not seen."""
+    with app.app_context():
+        original = UserEvent(
+            session_id='test-session',
+            event_type='click',
+            event_name='test_button',
+            client_event_id='stored-elsewhere'
+        )
+        db.session.add(original)
+        db.session.commit()
+        original_id = original.id
+
+    response = client.post('/events', json={
+        'event_type': 'click',
+        'event_name': 'test_button',
+        'event_id': 'stored-elsewhere'
+    })
+    assert response.status_code == 200
+    assert response.get_json()['event_id'] == original_id
+
+def test_sampled_events_are_weighted(client, app):
+    """Test that sampled events are stored with weights that aggregation sums."""
+    random.seed(1234)
+    app.config['EVENT_SAMPLING_RULES'] = {'scroll': {'rate': 0.25}}
+    app.extensions.pop('event_sampler', None)
+
+    responses = [client.post('/events', json={'event_type': 'scroll', 'event_name': 'feed'}) for _ in range(40)]
+    assert {response.status_code for response in responses} <= {201, 202}
+    assert all(response.get_json()['sample_rate'] == 0.25 for response in responses)
+    kept = sum(response.status_code == 201 for response in responses)
+
+    with app.app_context():
+        assert UserEvent.query.count() == kept
+        assert all(event.sample_weight == 4.0 for event in UserEvent.query.all())
+
+    response = client.post('/analytics/aggregate?period_type=hourly')
+    run = client.get(response.get_json()['status_url']).get_json()['data']
+    assert run['rows_scanned'] == kept
+    response = client.get('/stats/top-events?range=7d')
+    data = response.get_json()['data']
+    assert data[0]['total_count'] == kept * 4
+
+    response = client.get('/metrics/sampling')
+    assert response.get_json()['data']['scroll']['sample_rate'] == 0.25
+
+def test_duplicate_event_id_bypasses_sampling(client, app):
+    """Test that retries of a stored event id get the original even when heavily sampled."""
+    payload = {'event_type': 'scroll', 'event_name': 'feed', 'event_id': 'retried-scroll'}
+    response = client.post('/events', json=payload)
+    assert response.status_code == 201
+    original_id = response.get_json()['event_id']
+
+    app.config['EVENT_SAMPLING_RULES'] = {'scroll': {'rate': 0.01}}
+    app.extensions.pop('event_sampler', None)
+    for _ in range(20):
+        response = client.post('/events', json=payload)
+        assert response.status_code == 200
+        assert response.get_json()['event_id'] == original_id
+
+def test_precomputed_funnel_steps_are_not_sampled(client, app):
+    """Test that events feeding precomputed funnels are always kept."""
+    app.config['EVENT_SAMPLING_RULES'] = {'click': {'rate': 0.01}}
+    app.config['PRECOMPUTED_FUNNELS'] = {'cart': {'steps': ['view_product', 'add_to_cart']}}
+    app.extensions.pop('event_sampler', None)
+
+    for _ in range(10):
+        response = client.post('/events', json={'event_type': 'click', 'event_name': 'add_to_cart'})
+        assert response.status_code == 201
+        assert response.get_json()['sample_rate'] == 1.0
+
+def test_plan_rollups(app):
+    """Test that ranges are covered by the coarsest finalized rollups."""
+    with app.app_context():
+        for period_type, period_start in [
+            ('monthly', datetime(2025, 2, 1)),
+            ('daily', datetime(2025, 1, 31)),
+            ('daily', datetime(2025, 3, 1)),
+            ('daily', datetime(2025, 3, 2)),
+        ]:
+            db.session.add(AggregationPeriod(
+                period_type=period_type,
+                period_start=period_start,
+                finalized_at=datetime(2025, 6, 1)
+            ))
+        db.session.commit()
+
+        plan = plan_rollups(datetime(2025, 1, 30, 5, 30), datetime(2025, 3, 3, 10))
+
+    assert plan == (
+        [('hourly', datetime(2025, 1, 30, hour)) for hour in range(5, 24)]
+        + [('daily', datetime(2025, 1, 31)), ('monthly', datetime(2025, 2, 1)),
+           ('daily', datetime(2025, 3, 1)), ('daily', datetime(2025, 3, 2))]
+        + [('hourly', datetime(2025, 3, 3, hour)) for hour in range(10)]
+    )
+
+def test_top_events_does_not_mix_granularities(client, app):
+    """Test that overlapping rollups are not summed twice and open periods are read from hours."""
+    this_hour = datetime.now(UTC).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    today = this_hour.replace(hour=0)
+    week_start = today - timedelta(days=today.weekday())
+    with app.app_context():
+        # The daily and weekly rows are only written at the period boundary, so
+        # until finalized they are stale next to the hourly rollups
+        rows = [('daily', today, 1), ('weekly', week_start, 1),
+                ('hourly', this_hour - timedelta(hours=1), 500), ('hourly', this_hour, 2)]
+        for period_type, period_start, count in rows:
+            db.session.add(EventAggregate(
+                event_type='click',
+                event_name='test_button',
+                period_type=period_type,
+                period_start=period_start,
+                count=count,
+                device_type='desktop'
+            ))
+        db.session.add(AggregationPeriod(
+            period_type='hourly',
+            period_start=this_hour - timedelta(hours=1),
+            finalized_at=datetime.now(UTC)
+        ))
+        db.session.commit()
+
+    response = client.get('/stats/top-events?range=7d')
+    assert response.get_json()['data'][0]['total_count'] == 502
+
+    response = client.get('/stats/event-counts?event_name=test_button&range=7d')
+    data = response.get_json()
+    assert data['total_count'] == 502
+    assert [row['period_type'] for row in data['data']] == ['daily']
+
+def test_unfinalized_days_without_hours_use_daily_rows(client, app):
+    """Test that daily aggregates written before hourly rollups existed are still counted."""
+    today = datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    with app.app_context():
+        # Three days ago only has its daily row; two days ago also has hours,
+        # which are used instead of the stale daily row
+        rows = [('daily', today - timedelta(days=3), 7), ('daily', today - timedelta(days=2), 1),
+                ('hourly', today - timedelta(days=2, hours=-5), 4)]
+        for period_type, period_start, count in rows:
+            db.session.add(EventAggregate(
+                event_type='click',
+                event_name='test_button',
+                period_type=period_type,
+                period_start=period_start,
+                count=count,
+                device_type='desktop'
+            ))
+        db.session.commit()
+
+    response = client.get('/stats/top-events?range=7d')
+    assert response.get_json()['data'][0]['total_count'] == 11
+
+def test_aggregate_cache_matches_sql(client, app):
+    """Test that stats served from the columnar cache match the SQL path."""
+    today = datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+    with app.app_context():
+        for days_ago in range(1, 5):
+            db.session.add(AggregationPeriod(
+                period_type='daily',
+                period_start=today - timedelta(days=days_ago),
+                finalized_at=datetime.now(UTC)
+            ))
+        for i in range(12):
+            db.session.add(EventAggregate(
+                event_type='click' if i % 2 else 'view',
+                event_name=f'button_{i % 4}',
+                period_type='daily',
+                period_start=today - timedelta(days=i % 5),
+                count=i + 1,
+                device_type='mobile' if i % 3 else 'desktop'
+            ))
+        db.session.commit()
+
+    urls = [
+        '/stats/overview?range=7d&sort_by=count&per_page=5&page=2',
+        '/stats/overview?range=7d&sort_by=count&event_type=click&device_type=mobile',
+        '/stats/event-counts?event_name=button_1&range=7d&sort_by=count',
+        '/stats/top-events?range=7d&limit=3',
+    ]
+    expected = [client.get(url).get_json() for url in urls]
+
+    app.config['AGGREGATE_CACHE_ENABLED'] = True
+    assert [client.get(url).get_json() for url in urls] == expected
+
+    # A finished aggregation run is picked up incrementally
+    app.extensions['aggregate_cache'].refresh_seconds = 0
+    with app.app_context():
+        db.session.add(UserEvent(
+            session_id='test-session',
+            event_type='click',
+            event_name='fresh_button',
+            timestamp=datetime.now(UTC)
+        ))
+        db.session.commit()
+        services.aggregate_events('hourly')
+
+    data = client.get('/stats/top-events?range=7d&limit=20').get_json()['data']
+    assert {'event_type': 'click', 'event_name': 'fresh_button', 'total_count': 1} in data
+    assert app.extensions['aggregate_cache'].columns is not None
+
+def test_aggregate_cache_memory_cap(client, app):
+    """Test that periods evicted by the memory cap stay uncovered after a refresh."""
+    today = datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    with app.app_context():
+        aggregates = [EventAggregate(
+            event_type='click',
+            event_name='test_button',
+            period_type='daily',
+            period_start=today - timedelta(days=days_ago),
+            count=1,
+            device_type='desktop',
+            updated_at=datetime.now(UTC).replace(tzinfo=None) - timedelta(hours=1, minutes=days_ago)
+        ) for days_ago in range(6)]
+        db.session.add_all(aggregates)
+        db.session.commit()
+
+        cache = AggregateColumnCache(90, ROW_BYTES * 3, 0)
+        cache.refresh()
+        assert len(cache.columns['id']) == 3
+        assert cache.covers(today - timedelta(days=2))
+        assert not cache.covers(today - timedelta(days=5))
+
+        # An in-place update keeps the row count, and must not widen coverage
+        aggregates[0].count = 2
+        aggregates[0].updated_at = datetime.now(UTC).replace(tzinfo=None)
+        db.session.commit()
+        cache.refresh()
+        assert len(cache.columns['id']) == 3
+        assert int(cache.columns['count'].sum()) == 4
+        assert not cache.covers(today - timedelta(days=5))
+
+def test_admission_control_sheds_ingest_only(client, app):
+    """Test that a saturated ingest pool rejects fast without blocking stats."""
+    app.config['ADMISSION_POOLS'] = {
+        'ingest': {'max_concurrent': 1, 'max_queue': 0, 'target_latency': 0.25, 'retry_after': 2},
+        'stats': {'max_concurrent': 1}
+    }
+    app.extensions.pop('admission_pools', None)
+    pools = get_admission_pools(app)
+
+    assert pools['ingest'].acquire() is None
+    response = client.post('/events', json={'event_type': 'click', 'event_name': 'buy'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert client.get('/stats/overview').status_code == 200
+
+    # Creating a session for a new client is admitted too
+    new_client = app.test_client()
+    response = new_client.post('/events', json={'event_type': 'click', 'event_name': 'buy'})
+    assert response.status_code == 429
+    assert new_client.get('/stats/overview').status_code == 200
+    assert app.test_client().get('/metrics/sampling').status_code == 200
+
+    # A batch holds one slot per worker thread, so it waits for idle stats slots
+    pools['stats'].max_concurrent = 4
+    assert pools['stats'].acquire() is None
+    response = client.post('/stats/batch', json={'queries': [{'type': 'overview'}]})
+    assert response.status_code == 429
+    pools['stats'].release()
+    assert client.post('/stats/batch', json={'queries': [{'type': 'overview'}]}).status_code == 200
+    assert pools['stats'].active == 0
+
+    pools['ingest'].release()
+    response = client.post('/events', json={'event_type': 'click', 'event_name': 'buy'})
+    assert response.status_code == 201
+    assert pools['ingest'].latency is not None
+
+    # Latency well over the target shrinks the limit but keeps one slot open
+    pools['ingest'].max_concurrent = 8
+    pools['ingest'].latency = 1.0
+    assert pools['ingest'].limit() == 2
+    pools['ingest'].latency = 100.0
+    assert pools['ingest'].limit() == 1
@@ -0,0 +1,43 @@
+import json
+import argparse
+import pytest
+import loadgen
+
+def test_parse_mix():
+    """Test parsing request kind weights."""
+    assert loadgen.parse_mix('ingest=0.8,stats=0.2') == {'ingest': 0.8, 'stats': 0.2}
+    with pytest.raises(argparse.ArgumentTypeError):
+        loadgen.parse_mix('ingest=0.5,export=0.5')
+
+def test_load_replay_skips_other_lines(tmp_path):
+    """Test that replay keeps method/path requests and counts everything else as skipped."""
+    path = tmp_path / 'traffic.jsonl'
+    path.write_text('\n'.join([
+        json.dumps({'method': 'post', 'path': '/events', 'json': {'event_type': 'click', 'event_name': 'buy'}}),
+        json.dumps({'method': 'GET', 'path': '/stats/overview?range=7d'}),
+        json.dumps({'request_id': 'not-a-request'}),
+        'not json',
+    ]) + '\n')
+
+    requests, skipped = loadgen.load_replay(path)
+    assert requests == [
+        ('ingest', 'POST', '/events', {'event_type': 'click', 'event_name': 'buy'}),
+        ('stats', 'GET', '/stats/overview?range=7d', None),
+    ]
+    assert skipped == 2
+
+def test_percentile():
+    """Test percentiles picked from sorted latencies."""
+    values = list(range(101))
+    assert loadgen.percentile(values, 0.5) == 50
+    assert loadgen.percentile(values, 0.99) == 99
+    assert loadgen.percentile(values, 1.0) == 100
+    assert loadgen.percentile([], 0.5) == 0.0
+
+def test_inprocess_run_reports(capsys):
+    """Test a short in-process run against a temporary SQLite database."""
+    assert loadgen.main(['--requests', '20', '--concurrency', '2', '--seed', '1']) == 0
+    output = capsys.readouterr().out
+    assert output.startswith('20 requests in ')
+    assert 'p99 ms' in output
+    assert 'ingest' in output